@@ -0,0 +1,79 @@
+"""Compares per-render time of the rank card pipeline before and after CardTemplate.
+
+Run from the repository root:
+    python -m benchmarks.card_template [renders]
+"""
+import statistics
+import sys
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFont
+
+from rank_card import Generator, get_str
+
+from .fixtures import fixture_avatar
+
+
+def legacy_render(profile_bytes: bytes, level: int, user_xp: int, next_xp: int, user_name: str):
+    """The pipeline as it was before CardTemplate, minus the avatar download."""
+    card = Image.open('assets/card.jpg').convert("RGBA")
+    profile = Image.open(BytesIO(profile_bytes)).convert('RGBA').resize((180, 180))
+    profile_pic_holder = Image.new("RGBA", card.size, (255, 255, 255, 0))
+
+    mask = Image.new("RGBA", card.size)
+    ImageDraw.Draw(mask).ellipse((29, 29, 209, 209), fill=(255, 25, 255, 255))
+
+    font_normal = ImageFont.truetype('assets/font.ttf', 36)
+    font_small = ImageFont.truetype('assets/font.ttf', 20)
+    black = (0, 0, 0)
+
+    draw = ImageDraw.Draw(card)
+    draw.text((245, 35), user_name, black, font=font_normal)
+    draw.text((245, 123), f"Level {level}", black, font=font_small)
+    draw.text((245, 150), f"Exp {get_str(user_xp)}/{get_str(next_xp)}", black, font=font_small)
+
+    blank = Image.new("RGBA", card.size, (255, 255, 255, 0))
+    blank_draw = ImageDraw.Draw(blank)
+    blank_draw.rectangle((245, 185, 741, 205), fill=(255, 255, 255, 0), outline=black)
+    current_percentage = 100 if next_xp < user_xp else (user_xp / next_xp) * 100
+    blank_draw.rectangle((248, 188, (current_percentage * 4.9) + 248, 202), fill=black)
+
+    profile_pic_holder.paste(profile, (29, 29, 209, 209))
+    pre = Image.composite(profile_pic_holder, card, mask)
+    pre = Image.alpha_composite(pre, blank)
+    final = Image.alpha_composite(pre, blank)
+    final_bytes = BytesIO()
+    final.save(final_bytes, 'png')
+    final_bytes.seek(0)
+    return final_bytes
+
+
+def time_renders(render, renders: int) -> list:
+    avatar = fixture_avatar()
+    timings = []
+    for i in range(renders):
+        start = time.perf_counter()
+        render(avatar, level=i % 50 + 1, user_xp=i * 37, next_xp=(i % 50 + 1) * 1000, user_name=f'user{i}#0001')
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main(renders: int = 200):
+    avatar = fixture_avatar()
+    kwargs = {'level': 4, 'user_xp': 1234, 'next_xp': 4000, 'user_name': 'ppotatoo#9688'}
+    same = Image.open(legacy_render(avatar, **kwargs)).tobytes() == Image.open(Generator().generate_profile(avatar, **kwargs)).tobytes()
+    print(f"Output identical: {same}")
+
+    results = {
+        'legacy': time_renders(legacy_render, renders),
+        'template': time_renders(Generator().generate_profile, renders),
+    }
+    for name, timings in results.items():
+        print(f"{name:>8}: mean {statistics.mean(timings):.2f}ms, median {statistics.median(timings):.2f}ms")
+    speedup = statistics.mean(results['legacy']) / statistics.mean(results['template'])
+    print(f"Speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,62 @@
+"""Bytes per cached economy user, dicts (the old layout) against UserRecord.
+
+Run from the repository root:
+    python -m benchmarks.economy_memory [users]
+"""
+import random
+import sys
+import tracemalloc
+
+from utils.records import UserRecord
+
+
+def fake_rows(count: int) -> list:
+    rng = random.Random(0)
+    rows = []
+    for user_id in range(count):
+        rows.append({
+            'guild_id': 336642139381301249,
+            'user_id': 10 ** 17 + user_id,
+            'cash': rng.randint(0, 10 ** 6),
+            'vault': rng.randint(500, 10 ** 7),
+            # like asyncpg, every row decodes its own copy of the string
+            'pet_name': ''.join(['happy ', 'shiba']) if rng.random() < 0.95 else f'pet {user_id}',
+            'xp': rng.randint(300, 5000),
+            'level': rng.randint(1, 40),
+        })
+    return rows
+
+
+def as_dicts(rows) -> dict:
+    users = {}
+    for row in rows:
+        data = dict(row)
+        del data['guild_id']
+        users[data.pop('user_id')] = data
+    return users
+
+
+def as_records(rows) -> dict:
+    return {row['user_id']: UserRecord.from_row(row) for row in rows}
+
+
+def measure(build, rows) -> int:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    users = build(rows)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del users
+    return after - before
+
+
+def main(count: int = 100000):
+    results = {}
+    for name, build in (('dict', as_dicts), ('UserRecord', as_records)):
+        results[name] = measure(build, fake_rows(count)) / count
+        print(f"{name:>10}: {results[name]:.1f} bytes per user")
+    print(f"Saved {1 - results['UserRecord'] / results['dict']:.0%} per user")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,31 @@
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+
+def fixture_avatar(size=(256, 256), color=(114, 137, 218), mode="RGB") -> bytes:
+    avatar = Image.new(mode, size, color)
+    width, height = size
+    ImageDraw.Draw(avatar).ellipse((width // 4, height // 4, width * 3 // 4, height * 3 // 4), fill=(255, 255, 255))
+    buffer = BytesIO()
+    avatar.save(buffer, 'png')
+    return buffer.getvalue()
+
+
+# discord serves avatars in a handful of sizes, with and without transparency
+AVATARS = {
+    'rgb-128': fixture_avatar((128, 128)),
+    'rgb-256': fixture_avatar((256, 256)),
+    'rgba-256': fixture_avatar((256, 256), color=(87, 242, 135, 128), mode="RGBA"),
+    'rgb-1024': fixture_avatar((1024, 1024), color=(237, 66, 69)),
+}
+
+# (user_name, level, user_xp, next_xp), covering every branch of get_str
+CASES = (
+    ('ppotatoo#9688', 1, 20, 1000),
+    ('a#0001', 3, 999, 3000),
+    ('someone with a long name#1234', 12, 4500, 12000),
+    ('日本語の名前#4321', 80, 79999, 80000),
+    ('whale#0007', 1500, 1250000, 1500000),
+    ('overflow#0000', 2, 5000, 2000),
+)
@@ -0,0 +1,108 @@
+"""Time per statement on the work, withdraw and deposit paths: ad-hoc SQL against the prepared registry.
+
+Three ways of sending the same UPDATE are compared, both on the first call over a fresh connection and once
+the connection is warm:
+    uncached    ad-hoc text with asyncpg's statement cache off, so every call is parsed and planned
+    cached      ad-hoc text with asyncpg's default statement cache, which is what the bot did before
+    registry    utils.statements, prepared when the connection opens and run by name
+
+Needs a database with the schema loaded. The rows it touches are created and removed again.
+Run from the repository root:
+    python -m benchmarks.prepared_statements --dsn postgres://user@localhost/mao
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import asyncpg
+
+from utils.queries import InstrumentedConnection
+from utils.statements import STATEMENTS, prepare_statements
+
+GUILD_ID = 1
+USER_ID = 2
+PATHS = {
+    # the name of the statement, and its arguments
+    'work': ('add_cash', (500, GUILD_ID, USER_ID)),
+    'withdraw': ('withdraw', (10, GUILD_ID, USER_ID)),
+    'deposit': ('deposit', (10, GUILD_ID, USER_ID)),
+}
+
+
+async def time_calls(call, iterations: int) -> list:
+    times = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await call()
+        times.append(time.perf_counter() - started)
+    return times
+
+
+async def run_path(dsn: str, mode: str, name: str, args: tuple, iterations: int) -> tuple:
+    """Times of the first call on a fresh connection, and of ``iterations`` calls once it is warm."""
+    if mode == 'registry':
+        conn = await asyncpg.connect(dsn, connection_class=InstrumentedConnection)
+        # the pool's init hook
+        await prepare_statements(conn)
+
+        async def call():
+            await conn.run(name, *args)
+    else:
+        conn = await asyncpg.connect(dsn, statement_cache_size=0 if mode == 'uncached' else 100)
+
+        async def call():
+            await conn.execute(STATEMENTS[name], *args)
+
+    try:
+        first = await time_calls(call, 1)
+        await time_calls(call, min(iterations, 50))  # warm up the connection and the server's caches
+        return first, await time_calls(call, iterations)
+    finally:
+        await conn.close()
+
+
+async def main_async(args) -> None:
+    setup = await asyncpg.connect(args.dsn)
+    await setup.execute("INSERT INTO guilds (guild_id) VALUES ($1) ON CONFLICT DO NOTHING", GUILD_ID)
+    await setup.execute(
+        "INSERT INTO users (guild_id, user_id, vault) VALUES ($1, $2, 1000000000) ON CONFLICT DO NOTHING",
+        GUILD_ID, USER_ID
+    )
+    try:
+        modes = ['uncached', 'cached', 'registry']
+        print(f"{'path':<10} {'mode':<10} {'first':>9} {'mean':>9} {'p50':>9} {'p95':>9}")
+        for path, (name, values) in PATHS.items():
+            times = {mode: [] for mode in modes}
+            firsts = {mode: [] for mode in modes}
+            # interleaved and rotated, so table bloat from the repeated updates hits every mode the same
+            for round_ in range(args.rounds):
+                for mode in modes[round_ % 3:] + modes[:round_ % 3]:
+                    first, warm = await run_path(args.dsn, mode, name, values, args.iterations // args.rounds)
+                    firsts[mode] += first
+                    times[mode] += warm
+
+            baseline = statistics.mean(times['uncached'])
+            for mode in modes:
+                mean = statistics.mean(times[mode])
+                cuts = statistics.quantiles(times[mode], n=20)
+                print(
+                    f"{path:<10} {mode:<10} {statistics.mean(firsts[mode]) * 1e6:>7.1f}us {mean * 1e6:>7.1f}us {cuts[9] * 1e6:>7.1f}us {cuts[18] * 1e6:>7.1f}us"
+                    f"  {1 - mean / baseline:>6.1%} saved"
+                )
+    finally:
+        await setup.execute("DELETE FROM users WHERE guild_id = $1 AND user_id = $2", GUILD_ID, USER_ID)
+        await setup.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dsn', required=True)
+    parser.add_argument('--iterations', type=int, default=3000)
+    parser.add_argument('--rounds', type=int, default=6)
+    asyncio.run(main_async(parser.parse_args(argv)))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
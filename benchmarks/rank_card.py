@@ -0,0 +1,130 @@
+"""Offline benchmark suite for rank_card.Generator.
+
+Renders every fixture avatar against every case in benchmarks/fixtures.py and reports
+renders/sec, p50/p95 latency, mean encoded size and peak RSS. Results can be saved and compared against a
+previous run, exiting non-zero when the new run is slower than the allowed threshold.
+
+Run from the repository root:
+    python -m benchmarks.rank_card --output before.json
+    python -m benchmarks.rank_card --compare before.json --threshold 0.1
+    python -m benchmarks.rank_card --format webp --quality 80
+"""
+import argparse
+import json
+import platform
+import resource
+import statistics
+import sys
+import time
+
+import PIL
+
+from rank_card import CardEncoder, Generator
+from rank_card.encoding import FORMATS
+
+from .fixtures import AVATARS, CASES
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def percentile(values: list, pct: int) -> float:
+    return statistics.quantiles(values, n=100, method='inclusive')[pct - 1]
+
+
+def run(rounds: int = 5, warmup: int = 1, encoder: CardEncoder = None) -> dict:
+    generator = Generator(encoder=encoder)
+    timings = []
+    sizes = []
+    per_case = {}
+
+    for round_ in range(warmup + rounds):
+        for avatar_name, avatar in AVATARS.items():
+            for user_name, level, user_xp, next_xp in CASES:
+                start = time.perf_counter()
+                card = generator.generate_profile(
+                    avatar, level=level, user_xp=user_xp, next_xp=next_xp, user_name=user_name
+                )
+                elapsed = (time.perf_counter() - start) * 1000
+                if round_ < warmup:
+                    continue
+                timings.append(elapsed)
+                sizes.append(len(card.getbuffer()))
+                per_case.setdefault(f"{avatar_name}/{user_name}", []).append(elapsed)
+
+    total = sum(timings) / 1000
+    return {
+        'encoder': vars(generator.encoder),
+        'pillow': PIL.__version__,
+        'python': platform.python_version(),
+        'renders': len(timings),
+        'renders_per_sec': len(timings) / total,
+        'p50_ms': percentile(timings, 50),
+        'p95_ms': percentile(timings, 95),
+        'mean_bytes': statistics.mean(sizes),
+        'peak_rss': peak_rss(),
+        'cases': {name: statistics.median(values) for name, values in per_case.items()},
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    """Returns a line for each metric that got worse by more than ``threshold``."""
+    regressions = []
+    for metric in ('p50_ms', 'p95_ms', 'mean_bytes', 'peak_rss'):
+        if metric in baseline and current[metric] > baseline[metric] * (1 + threshold):
+            regressions.append(f"{metric}: {baseline[metric]:.2f} -> {current[metric]:.2f}")
+    if current['renders_per_sec'] < baseline['renders_per_sec'] * (1 - threshold):
+        regressions.append(
+            f"renders_per_sec: {baseline['renders_per_sec']:.2f} -> {current['renders_per_sec']:.2f}"
+        )
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--format', choices=FORMATS, default='png')
+    parser.add_argument('--compress-level', type=int, default=6)
+    parser.add_argument('--optimize', action='store_true')
+    parser.add_argument('--colors', type=int, default=256)
+    parser.add_argument('--quality', type=int, default=90)
+    parser.add_argument('--lossless', action='store_true')
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="JSON file from an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=0.1, help="allowed slowdown, 0.1 is 10%%")
+    args = parser.parse_args(argv)
+
+    encoder = CardEncoder(
+        format=args.format, compress_level=args.compress_level, optimize=args.optimize,
+        colors=args.colors, quality=args.quality, lossless=args.lossless
+    )
+    results = run(rounds=args.rounds, warmup=args.warmup, encoder=encoder)
+    print(
+        f"Pillow {results['pillow']} on Python {results['python']}: {results['renders']} renders as {encoder}\n"
+        f"{results['renders_per_sec']:.1f} renders/sec, "
+        f"p50 {results['p50_ms']:.2f}ms, p95 {results['p95_ms']:.2f}ms, "
+        f"{results['mean_bytes'] / 1024:.1f}KiB per card, "
+        f"peak RSS {results['peak_rss'] / 1024 / 1024:.1f}MiB"
+    )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.threshold)
+        if regressions:
+            print("Regressions against " + args.compare + ":\n  " + "\n  ".join(regressions))
+            return 1
+        print(f"No regressions against {args.compare}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,4 @@
+import time
 from dataclasses import dataclass
 
 from discord.ext import commands
@@ -13,6 +14,21 @@ class CommandMixin:
         self.bot_perms: tuple = attrs.pop("bot_perms", ('Send Messages',))
         self.cd: Cooldown = attrs.pop("cd", None)
 
+    # both add to ctx.timings for the profiler hooks on Mao
+    async def can_run(self, ctx):
+        started = time.perf_counter()
+        try:
+            return await super().can_run(ctx)
+        finally:
+            ctx.timings['check'] = ctx.timings.get('check', 0.0) + time.perf_counter() - started
+
+    async def _parse_arguments(self, ctx):
+        started = time.perf_counter()
+        try:
+            return await super()._parse_arguments(ctx)
+        finally:
+            ctx.timings['convert'] = ctx.timings.get('convert', 0.0) + time.perf_counter() - started
+
 class Command(CommandMixin, commands.Command):
     pass
 
@@ -1,3 +1,4 @@
+import logging
 import time
 
 from discord.ext import commands, tasks
@@ -5,18 +6,42 @@ from discord.ext import commands, tasks
 from core import Command
 from utils import CustomContext, Mao
 
+log = logging.getLogger("Cooldowns")
+
 
 class CooldownManager(commands.Cog):
     def __init__(self, bot):
         self.bot: Mao = bot
+        self.flush_cooldowns_task.change_interval(
+            seconds=self.bot.settings.get('cooldowns', {}).get('flush_seconds', 30)
+        )
+        self.flush_cooldowns_task.start()
         self.destroy_expired_cooldowns.start()
 
     def cog_unload(self):
+        self.flush_cooldowns_task.stop()
         self.destroy_expired_cooldowns.stop()
+        self.bot.loop.create_task(self.flush_cooldowns())
+
+    async def flush_cooldowns(self):
+        try:
+            written = await self.bot.pool.flush_cooldowns()
+        except Exception:
+            log.exception("Failed to write cooldowns")
+        else:
+            if written:
+                log.debug(f"Wrote {written} cooldowns")
+
+    @tasks.loop(seconds=30)
+    async def flush_cooldowns_task(self):
+        await self.flush_cooldowns()
 
     @tasks.loop(hours=1)
     async def destroy_expired_cooldowns(self):
-        await self.bot.pool.execute("DELETE FROM cooldowns WHERE expires < $1", time.time())
+        # both only touch what has expired since the last run, thanks to the wheel and cooldowns_expires_idx
+        now = time.time()
+        self.bot.pool.cooldowns.purge(now)
+        await self.bot.pool.execute("DELETE FROM cooldowns WHERE expires < $1", now)
 
     @commands.Cog.listener()
     async def on_command_completion(self, ctx: CustomContext):
@@ -25,7 +50,7 @@ class CooldownManager(commands.Cog):
         if not ctx.command.cd:
             return
         epoch = time.time() + ctx.command.cd.rate
-        await self.bot.pool.set_cooldown(ctx, epoch, ctx.command.cd.guild)
+        self.bot.pool.set_cooldown(ctx, epoch, ctx.command.cd.guild)
 
 
 def setup(bot):
@@ -1,20 +1,26 @@
-import functools
 import logging
 import math
 import random
 import shlex
+import time
 import typing
+from collections import OrderedDict, defaultdict
 from dataclasses import dataclass
+from io import BytesIO
 
 import discord
 from discord.ext import commands, tasks
 
 import core
-from rank_card import Generator
-from utils import Arguments, CustomContext, Mao, messages, parse_number
+from rank_card import CardCache, CardEncoder
+from rank_card.avatars import AvatarCache
+from rank_card.service import RenderQueueFull, RenderService
+from utils import Arguments, CustomContext, Mao, messages, metrics, parse_number
 
 log = logging.getLogger("Economy")
 
+LEADERBOARD_CURSOR_SECONDS = 60
+
 
 @dataclass
 class Pet:
@@ -28,32 +34,63 @@ class Economy(commands.Cog):
     def __init__(self, bot):
         self.bot: Mao = bot
         self.help_name = f"\N{MONEY WITH WINGS} {self.__class__.__name__}"
-        self._data_batch = []
+        self._xp_batch = defaultdict(int)
+        self._xp_messages = 0
+        self._lb_cursors = OrderedDict()
+        economy_settings = self.bot.settings.get('economy', {})
+        self.bulk_insert_task.change_interval(seconds=economy_settings.get('xp_flush_seconds', 20))
+        self.journal_sync_task.change_interval(seconds=economy_settings.get('journal_sync_seconds', 1))
         self.bulk_insert_task.start()
+        self.journal_sync_task.start()
         self._cooldown = commands.CooldownMapping.from_cooldown(2, 5, commands.BucketType.member)
 
         self.economy = self.bot.pool.economy
+        card_settings = self.bot.settings.get('rank_card', {})
+        self.card_cache = CardCache(
+            max_entries=card_settings.get('cache_entries', 512),
+            max_bytes=card_settings.get('cache_bytes', 32 * 1024 * 1024)
+        )
+        self.avatar_cache = AvatarCache(
+            # each process trims its own directory to the budget, sharing one they'd evict each other's files
+            path=self.bot.cluster_path(card_settings.get('avatar_cache_path', 'avatar_cache')),
+            max_bytes=card_settings.get('avatar_cache_bytes', 64 * 1024 * 1024)
+        )
+        self.renderer = RenderService(
+            workers=card_settings.get('workers', 2),
+            max_queue=card_settings.get('max_queue', 16),
+            encoder=CardEncoder(**card_settings.get('encoder', {}))
+        )
 
     def cog_unload(self):
-        self.bot.loop.create_task(self.bulk_insert_task)
         self.bulk_insert_task.stop()
+        self.journal_sync_task.stop()
+        self.bot.loop.create_task(self.bulk_insert())
+        self.renderer.close()
 
     async def bulk_insert(self):
-        if not self._data_batch:
+        if not self._xp_batch:
+            return
+        batch, messages = self._xp_batch, self._xp_messages
+        self._xp_batch, self._xp_messages = defaultdict(int), 0
+        started = time.monotonic()
+        self.bot.xp_journal.rotate()
+
+        try:
+            await self.economy.flush_xp(batch)
+        except Exception:
+            # put the XP back so the next flush picks it up
+            for key, xp in batch.items():
+                self._xp_batch[key] += xp
+            self._xp_messages += messages
+            metrics.XP_FLUSH_FAILURES.inc()
+            log.exception("Failed to insert XP")
             return
-        async with self.bot.pool.acquire() as conn:
-            query = (
-                """
-                UPDATE users SET xp = xp + $3
-                WHERE guild_id = $1 AND user_id = $2
-                """
-            )
-            await conn.executemany(
-                query,
-                tuple((m['guild'], m['user'], m['xp']) for m in self._data_batch)
-            )
-        log.info(f"Inserted XP. Messages: {len(self._data_batch)}")
-        self._data_batch.clear()
+        self.bot.xp_journal.commit()
+        self.economy.flushed(started)
+        metrics.XP_FLUSH.observe(time.monotonic() - started)
+        metrics.XP_BATCH_USERS.observe(len(batch))
+        metrics.XP_BATCH_MESSAGES.inc(messages)
+        log.info(f"Inserted XP. Users: {len(batch)}, messages: {messages}")
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
@@ -69,19 +106,20 @@ class Economy(commands.Cog):
         if retry_after:
             return
         xp = random.randint(15, 56)
-        self.economy.cache[message.guild.id][message.author.id]['xp'] += xp
-        self._data_batch.append(
-            {
-                'guild': message.guild.id,
-                'user': message.author.id,
-                'xp': xp
-            }
-        )
+        if not await self.economy.add_xp(message.guild.id, message.author.id, xp):
+            return
+        self._xp_batch[(message.guild.id, message.author.id)] += xp
+        self._xp_messages += 1
+        self.bot.xp_journal.append(message.guild.id, message.author.id, xp)
 
     @tasks.loop(seconds=20)
     async def bulk_insert_task(self):
         await self.bulk_insert()
 
+    @tasks.loop(seconds=1)
+    async def journal_sync_task(self):
+        await self.bot.loop.run_in_executor(None, self.bot.xp_journal.sync)
+
     @core.command(
         name="toggle-leveling",
         aliases=('toggleleveling', 'toggle_leveling'),
@@ -127,9 +165,7 @@ class Economy(commands.Cog):
         user = user or ctx.author
         data = await self.economy.get_user(ctx, user_id=user.id)
         level = data['level']
-        total_xp = data['xp'] - 1000
-        for num in range(level + 1):
-            total_xp += num * 1000
+        total_xp = self.bot.pool.level_curve(ctx.guild.id).total_xp(level, data['xp'])
 
         message = (
             f"💸 **Cash** → {data['cash']}",
@@ -153,21 +189,15 @@ class Economy(commands.Cog):
             return await ctx.send("Leveling isn't enabled on your server.")
         data = await self.economy.get_user(ctx)
         level = data['level']
-        cost = level * 1000
-        xp_needed = max((level * 1000) - data['xp'], 0)
+        cost = self.bot.pool.level_curve(ctx.guild.id).threshold(level)
+        xp_needed = max(cost - data['xp'], 0)
 
         if xp_needed != 0:
             return await ctx.send(f"You need {xp_needed} more XP in order to level up to level {level + 1}")
 
-        query = (
-            """
-            UPDATE users SET level = level + 1, xp = $3
-            WHERE guild_id = $1 AND user_id = $2
-            """
-        )
-        await self.bot.pool.execute(query, ctx.guild.id, ctx.author.id, data['xp'] - cost)
-        self.economy.cache[ctx.guild.id][ctx.author.id]['level'] += 1
-        self.economy.cache[ctx.guild.id][ctx.author.id]['xp'] = data['xp'] - cost
+        if not await self.economy.level_up(ctx, level=level, cost=cost):
+            return await ctx.send(f"You're not on level {level} anymore.")
+        self.card_cache.invalidate(ctx.author.id)
         await ctx.send(f"Leveled you up to level {level + 1}!")
 
     @core.command(
@@ -184,15 +214,24 @@ class Economy(commands.Cog):
         user = user or ctx.author
         data = await self.economy.get_user(ctx, user_id=user.id)
         kwargs = {
-            'profile_image': user.avatar_url_as(format="png"),
             'level': data['level'],
             'user_xp': data['xp'],
-            'next_xp': data['level'] * 1000,
+            'next_xp': self.bot.pool.level_curve(ctx.guild.id).threshold(data['level']),
             'user_name': str(user),
         }
-        generator = functools.partial(Generator().generate_profile, **kwargs)
-        image = await self.bot.loop.run_in_executor(None, generator)
-        file = discord.File(fp=image, filename="image.png")
+        key = self.card_cache.make_key(
+            user.id, user.avatar, kwargs['level'], kwargs['user_xp'], kwargs['next_xp'], kwargs['user_name']
+        )
+        image = self.card_cache.get(key)
+        if image is None:
+            kwargs['profile_bytes'] = await self.avatar_cache.fetch(self.bot.session, user)
+            try:
+                image = await self.renderer.render(**kwargs)
+            except RenderQueueFull:
+                ctx.command.reset_cooldown(ctx)
+                return await ctx.send("I'm drawing a lot of rank cards right now, try again in a few seconds.")
+            self.card_cache.put(key, image)
+        file = discord.File(fp=BytesIO(image), filename=f"image.{self.renderer.encoder.extension}")
         await ctx.send(file=file)
 
     @core.command(cd=core.Cooldown(rate=300, guild=True))
@@ -208,10 +247,9 @@ class Economy(commands.Cog):
     )
     async def withdraw(self, ctx: CustomContext, amount: str):
         """Withdraw money from your vault."""
-        async with self.bot.pool.acquire() as conn:
-            data = await self.economy.get_user(ctx)
-            amount = parse_number(argument=amount, total=data['vault'])
-            await self.economy.withdraw(ctx, amount=amount, conn=conn)
+        data = await self.economy.get_user(ctx)
+        amount = parse_number(argument=amount, total=data['vault'])
+        await self.economy.withdraw(ctx, amount=amount)
         await ctx.send(embed=self.bot.embed(ctx, description=f"You withdraw **${amount}** from your vault."))
 
     @core.command(
@@ -220,10 +258,9 @@ class Economy(commands.Cog):
     )
     async def deposit(self, ctx: CustomContext, amount: str):
         """Withdraw money from your vault."""
-        async with self.bot.pool.acquire() as conn:
-            data = await self.economy.get_user(ctx)
-            amount = parse_number(argument=amount, total=data['cash'])
-            await self.economy.deposit(ctx, amount=amount, conn=conn)
+        data = await self.economy.get_user(ctx)
+        amount = parse_number(argument=amount, total=data['cash'])
+        await self.economy.deposit(ctx, amount=amount)
         await ctx.send(embed=self.bot.embed(ctx, description=f"You deposit **${amount}** to your vault."))
 
     @core.command(
@@ -253,21 +290,29 @@ class Economy(commands.Cog):
     )
     async def leaderboard(self, ctx: CustomContext, page: typing.Optional[int] = 1, flags: str = None):
         queries = {
-            'count': "SELECT COUNT(user_id) FROM users",
+            'count': "SELECT user_count FROM guilds WHERE guild_id = $1",
             'total': {
-                'query': "SELECT user_id, cash + vault AS total FROM users WHERE guild_id = $1 ORDER BY cash + vault     DESC OFFSET $2 LIMIT 10",
+                'query': "SELECT user_id, cash + vault AS total FROM users WHERE guild_id = $1 {seek} ORDER BY cash + vault DESC, user_id DESC {offset} LIMIT 10",
+                'seek': "AND (cash + vault, user_id) < ($2, $3)",
+                'key': ('total', 'user_id'),
                 'line': "**{num}.** **{name}** » **${total}**"
             },
             'cash': {
-                'query': "SELECT user_id, cash AS total FROM users WHERE guild_id = $1 ORDER BY cash DESC OFFSET $2 LIMIT 10",
+                'query': "SELECT user_id, cash AS total FROM users WHERE guild_id = $1 {seek} ORDER BY cash DESC, user_id DESC {offset} LIMIT 10",
+                'seek': "AND (cash, user_id) < ($2, $3)",
+                'key': ('total', 'user_id'),
                 'line': "**{num}.** **{name}** » **${total}**"
             },
             'vault': {
-                'query': "SELECT user_id, vault AS total FROM users WHERE guild_id = $1 ORDER BY vault DESC OFFSET $2 LIMIT 10",
+                'query': "SELECT user_id, vault AS total FROM users WHERE guild_id = $1 {seek} ORDER BY vault DESC, user_id DESC {offset} LIMIT 10",
+                'seek': "AND (vault, user_id) < ($2, $3)",
+                'key': ('total', 'user_id'),
                 'line': "**{num}.** **{name}** » **${total}**"
             },
             'xp': {
-                'query': "SELECT user_id, level, xp FROM users WHERE guild_id = $1 ORDER BY level DESC OFFSET $2 LIMIT 10",
+                'query': "SELECT user_id, level, xp FROM users WHERE guild_id = $1 {seek} ORDER BY level DESC, xp DESC, user_id DESC {offset} LIMIT 10",
+                'seek': "AND (level, xp, user_id) < ($2, $3, $4)",
+                'key': ('level', 'xp', 'user_id'),
                 'line': "**{num}.** **{name}** » Level: **{level}** Total XP: **{total_xp}**"
             }
         }
@@ -288,35 +333,66 @@ class Economy(commands.Cog):
                 flag = 'vault'
             if args.level:
                 flag = 'xp'
-        query = queries[flag]['query']
         line_type = queries[flag]['line']
 
-        async with self.bot.pool.acquire() as conn:
-            count = await conn.fetchval(queries['count'])
-
-            max_pages = math.ceil(count / 10)
-            page = min(page, max_pages)
-
-            data = await conn.fetch(query, ctx.guild.id, (page * 10) - 10)
-
+        ranking = self.economy.rankings.get(ctx.guild.id)
+        if ranking is not None:
+            max_pages = max(math.ceil(len(ranking) / 10), 1)
+            page = max(min(page, max_pages), 1)
+            data = []
+            for user_id in ranking.page(flag, page):
+                user = self.economy.from_cache(ctx.guild.id, user_id)
+                total = user['cash'] + user['vault'] if flag == 'total' else user.get(flag)
+                data.append({**user, 'user_id': user_id, 'total': total})
+        else:  # this guild isn't cached, so don't load every user just to show ten
+            async with self.bot.pool.acquire() as conn:
+                count = await conn.fetchval(queries['count'], ctx.guild.id) or 0
+
+                max_pages = max(math.ceil(count / 10), 1)
+                page = max(min(page, max_pages), 1)
+
+                # seek past the end of the previous page when the same person has just looked at it,
+                # an older cursor can point into the middle of what is now a different page
+                query = queries[flag]
+                cursor = self._lb_cursors.get((ctx.guild.id, ctx.author.id, flag, page - 1))
+                if cursor and time.monotonic() - cursor[0] < LEADERBOARD_CURSOR_SECONDS:
+                    data = await conn.fetch(
+                        query['query'].format(seek=query['seek'], offset=''), ctx.guild.id, *cursor[1]
+                    )
+                else:
+                    data = await conn.fetch(
+                        query['query'].format(seek='', offset='OFFSET $2'), ctx.guild.id, (page * 10) - 10
+                    )
+
+            if data:
+                key = (ctx.guild.id, ctx.author.id, flag, page)
+                self._lb_cursors[key] = (time.monotonic(), tuple(data[-1][field] for field in query['key']))
+                self._lb_cursors.move_to_end(key)
+                while len(self._lb_cursors) > 1024:
+                    self._lb_cursors.popitem(last=False)
+
+        names = await self.bot.names.resolve(ctx.guild, [user['user_id'] for user in data])
+        total_xps = [None] * len(data)
+        if flag == 'xp':
+            total_xps = self.bot.pool.level_curve(ctx.guild.id).total_xp_many((u['level'], u['xp']) for u in data)
         lines = []
-        for num, user in enumerate(data, start=1):
+        for num, (user, total_xp) in enumerate(zip(data, total_xps), start=(page * 10) - 9):
+            name = names[user['user_id']] or f"Unknown User ({user['user_id']})"
             kwargs = {
                 'num': num,
-                'name': discord.utils.escape_markdown(str(await self.bot.try_user(user['user_id']))),
-                'total_xp': None,
+                'name': discord.utils.escape_markdown(name),
+                'total_xp': total_xp,
                 'level': None,
                 'total': None
             }
             if flag == 'xp':
                 kwargs['level'] = user['level']
-                kwargs['total_xp'] = user['xp'] - 1000
-                for num in range(user['level'] + 1):
-                    kwargs['total_xp'] += num * 1000
             if flag in ('cash', 'vault', 'total'):
                 kwargs['total'] = user['total']
             lines.append(line_type.format_map(kwargs))
         lines.append(f"\nPage {page}/{max_pages}")
+        if ranking is not None and (rank := ranking.rank(flag, ctx.author.id)):
+            lines.append(f"You are ranked **#{rank}**")
 
         embed = self.bot.embed(ctx, title=f"{ctx.guild.name} Leaderboard", description="\n".join(lines))
         await ctx.send(embed=embed)
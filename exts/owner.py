@@ -14,7 +14,9 @@ from jishaku.paginators import PaginatorInterface, WrappedPaginator
 from tabulate import tabulate
 
 import core
-from utils import CustomContext, Mao, Timer, codeblock
+from utils import CustomContext, Mao, Timer, codeblock, queries
+from utils.cluster import query_status
+from utils.profiler import PHASES
 
 
 async def send(ctx: CustomContext, result, stdout_):
@@ -114,21 +116,113 @@ class Admin(commands.Cog):
                 value = stdout.getvalue()
                 return await ctx.send(f"```py\n{value}{exception}```"[:1990])
 
+    @core.command(name='render-stats', aliases=('renderstats',))
+    async def render_stats(self, ctx: CustomContext):
+        economy = self.bot.get_cog('Economy')
+        stats = economy.renderer.stats()
+        cache = economy.card_cache
+
+        def fmt(ms):
+            return 'n/a' if ms is None else f'{ms:.2f}ms'
+
+        lines = (
+            f"Queue: {stats['queue_depth']}/{stats['max_queue']} ({stats['workers']} workers)",
+            f"Rendered: {stats['rendered']}, rejected: {stats['rejected']}",
+            f"Render: p50 {fmt(stats['render_ms']['p50'])}, p95 {fmt(stats['render_ms']['p95'])}, "
+            f"{stats['mean_bytes'] or 0:.0f} bytes on average as {stats['format']}",
+            f"Wait: p50 {fmt(stats['wait_ms']['p50'])}, p95 {fmt(stats['wait_ms']['p95'])}",
+            f"Card cache: {len(cache)} cards, {cache.size} bytes, {cache.hits} hits, {cache.misses} misses",
+        )
+        await ctx.send(codeblock('\n'.join(lines), lang=''))
+
+    @core.command(name='cache-stats', aliases=('cachestats',))
+    async def cache_stats(self, ctx: CustomContext):
+        stats = self.pool.economy.stats()
+        lines = (
+            f"Guilds: {stats['guilds']}, users: {stats['users']}/{stats['max_users']}",
+            f"Hits: {stats['hits']}, misses: {stats['misses']}, evictions: {stats['evictions']}",
+        )
+        await ctx.send(codeblock('\n'.join(lines), lang=''))
+
+    @core.command(name='slow-commands', aliases=('slowcommands', 'cmdprofile'))
+    async def slow_commands(self, ctx: CustomContext, phase: str = 'total', limit: int = 10):
+        """Commands with the worst p95 for a phase: check, convert, callback, reply or total."""
+        if phase not in PHASES:
+            return await ctx.send(f"Phase has to be one of {', '.join(PHASES)}.")
+        slowest = self.bot.profiler.slowest(limit, phase)
+        if not slowest:
+            return await ctx.send("No commands have been profiled yet.")
+
+        lines = [f"{'command':<20} {'calls':>6} {'p50':>9} {'p95':>9} {'p99':>9}  p95 by phase"]
+        for command, calls, stats in slowest:
+            row = stats[phase]
+            phases = ', '.join(f"{name} {stats[name]['p95']:.1f}" for name in PHASES[:-1])
+            lines.append(
+                f"{command:<20} {calls:>6} {row['p50']:>7.1f}ms {row['p95']:>7.1f}ms {row['p99']:>7.1f}ms  {phases}"
+            )
+        await ctx.send(codeblock('\n'.join(lines), lang=''))
+
+    @core.command(name='query-stats', aliases=('querystats',))
+    async def query_stats(self, ctx: CustomContext, limit: int = 10):
+        """Query templates that have taken the most time in total."""
+        stats = queries.stats
+        lines = [
+            f"Acquires: {stats.acquires}, waited {stats.acquire_wait * 1000:.1f}ms in total, "
+            f"{stats.acquire_max * 1000:.1f}ms at most"
+        ]
+        for query, template in stats.top(limit):
+            lines.append(
+                f"{template.total * 1000:>9.1f}ms {template.calls:>7} calls "
+                f"{template.total / template.calls * 1000:>7.2f}ms avg {template.max * 1000:>7.1f}ms max "
+                f"{template.rows:>8} rows  {textwrap.shorten(query, 80)}"
+            )
+        table = '\n'.join(lines)
+        if len(table) > 1900:
+            table = await ctx.mystbin(table)
+        await ctx.send(codeblock(table, lang=''))
+
+    @core.command(name='cluster-status', aliases=('clusterstatus',))
+    async def cluster_status(self, ctx: CustomContext):
+        settings = self.bot.settings.get('cluster', {})
+        try:
+            status = await query_status(settings.get('status_host', '127.0.0.1'), settings.get('status_port', 8765))
+        except OSError:
+            return await ctx.send("Not running under launcher.py.")
+
+        lines = [f"{status['shard_count']} shards, {status['guilds']} guilds, {status['users']} users"]
+        for cluster in status['clusters']:
+            state = 'stale' if cluster['stale'] else ('up' if cluster['alive'] else 'down')
+            latency = max(cluster.get('latencies', {}).values(), default=0)
+            lines.append(
+                f"#{cluster['cluster_id']} shards {cluster['shard_ids'][0]}-{cluster['shard_ids'][-1]}: {state}, "
+                f"{cluster.get('guilds', 0)} guilds, {cluster.get('economy_users', 0)} cached users, "
+                f"{latency:.0f}ms, {cluster['restarts']} restarts"
+            )
+        await ctx.send(codeblock('\n'.join(lines), lang=''))
+
     @core.group()
     async def sql(self, ctx: CustomContext):
         if not ctx.invoked_subcommand:
             await ctx.send_help(ctx.command)
 
+    async def run_sql(self, method: str, query: str):
+        async with self.pool.acquire() as conn:
+            if self.bot.cache_listener:
+                # not our usual application_name, so our own CacheListener applies whatever this changes.
+                # not SET LOCAL, VACUUM and the like can't run in a transaction. The pool's RESET ALL puts it back
+                await conn.execute("SET application_name = 'mao:sql'")
+            return await getattr(conn, method)(query.strip('`'))
+
     @sql.command(aliases=('e',))
     async def execute(self, ctx: CustomContext, *, query: str):
         with Timer() as timer:
-            ret = await self.pool.execute(query.strip('`'))
+            ret = await self.run_sql('execute', query)
         await ctx.send(f"`{ret}`\n**Executed in {timer.ms}ms**")
 
     @sql.command(aliases=('f',))
     async def fetch(self, ctx: CustomContext, *, query: str):
         with Timer() as timer:
-            ret = await self.pool.fetch(query.strip('`'))
+            ret = await self.run_sql('fetch', query)
         table = tabulate(
             (dict(row) for row in ret),
             headers='keys',
@@ -141,7 +235,7 @@ class Admin(commands.Cog):
     @sql.command(aliases=('fv',))
     async def fetchval(self, ctx: CustomContext, *, query: str):
         with Timer() as timer:
-            ret = await self.pool.fetchval(query.strip('`'))
+            ret = await self.run_sql('fetchval', query)
         await ctx.send(f"{codeblock(f'{ret!r}')}\n**Retrieved in {timer.ms}ms**")
 
     @sql.error
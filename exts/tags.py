@@ -64,30 +64,17 @@ class Tags(commands.Cog):
                 await ctx.send(f"yep created tag {name}")
 
     async def get_tag(self, ctx, name):  # sourcery skip: move-assign
-        query = """
-                SELECT 
-                    tags.name, tags.content
-                FROM
-                    tag_search
-                INNER JOIN
-                    tags ON
-                        tags.tag_id = tag_search.tag_id
-                WHERE
-                    tag_search.guild_id = $1 AND LOWER(tag_search.name) = $2
-                """
-        async with self.pool.acquire() as conn:
-            tag = await conn.fetchrow(query, ctx.guild.id, name.lower())
-            if not tag:
-                raise commands.BadArgument("bruh you gotta create dis")
-            return dict(tag)
+        tag = await self.pool.run('get_tag', ctx.guild.id, name.lower(), method='fetchrow')
+        if not tag:
+            raise commands.BadArgument("bruh you gotta create dis")
+        return dict(tag)
 
     @core.group(cd=core.Cooldown(2, False), invoke_without_command=True)
     async def tag(self, ctx: CustomContext, *, tag_name: TagName()):
         tag = await self.get_tag(ctx, tag_name)
         await ctx.send(tag['content'])
 
-        query = "UPDATE tags SET uses = uses + 1 WHERE name = $2 AND guild_id = $1"
-        await self.pool.execute(query, ctx.guild.id, tag['name'])
+        await self.pool.run('use_tag', ctx.guild.id, tag['name'])
 
     @tag.command()
     async def create(self, ctx: CustomContext, name, *, content: commands.clean_content):
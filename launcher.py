@@ -0,0 +1,215 @@
+"""Runs Mao as several processes, each one connecting its own range of shards.
+
+    python launcher.py            start the cluster
+    python launcher.py status     print what every process last reported
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+import aiohttp
+import toml
+
+from utils.cluster import query_status, shard_ranges
+
+logger = logging.getLogger("Launcher")
+logging.basicConfig(
+    format="%(levelname)s (%(name)s) |:| %(message)s |:| %(pathname)s:%(lineno)d",
+    level=logging.INFO,
+)
+
+
+def run_cluster(cluster_id: int, shard_ids: list, shard_count: int, status_queue) -> None:
+    import main  # not at the top, main.py only has to be importable in the child processes
+
+    bot = main.create_bot(
+        shard_ids=shard_ids,
+        shard_count=shard_count,
+        cluster_id=cluster_id,
+        status_queue=status_queue
+    )
+    bot.run(bot.settings['core']['token'])
+
+
+async def recommended_shards(token: str) -> int:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            "https://discord.com/api/v8/gateway/bot",
+            headers={'Authorization': f"Bot {token}"}
+        ) as resp:
+            resp.raise_for_status()
+            return (await resp.json())['shards']
+
+
+class Launcher:
+    def __init__(self, settings: dict, clusters: int, shards: int):
+        self.settings = settings
+        cluster_settings = settings.get('cluster', {})
+        self.clusters = clusters or cluster_settings.get('processes') or os.cpu_count()
+        self.shard_count = shards or cluster_settings.get('shards', 0)
+        self.host = cluster_settings.get('status_host', '127.0.0.1')
+        self.port = cluster_settings.get('status_port', 8765)
+        self.status_seconds = cluster_settings.get('status_seconds', 10)
+        self.max_restart_delay = cluster_settings.get('max_restart_delay', 300)
+
+        self._mp = multiprocessing.get_context('spawn')
+        self.status_queue = self._mp.Queue()
+        self.processes = {}
+        self.ranges = []
+        self.reports = {}
+        self.restarts = {}
+        self._started = {}
+        self._failures = {}  # exits in a row that came soon after starting
+        self._restart_at = {}
+        self._closing = False
+
+    def spawn(self, cluster_id: int) -> None:
+        process = self._mp.Process(
+            target=run_cluster,
+            args=(cluster_id, self.ranges[cluster_id], self.shard_count, self.status_queue),
+            name=f"mao-cluster-{cluster_id}",
+            daemon=False
+        )
+        process.start()
+        self.processes[cluster_id] = process
+        self._started[cluster_id] = time.monotonic()
+        logger.info(f"Started cluster {cluster_id} (pid {process.pid}) with shards {self.ranges[cluster_id]}")
+
+    def status(self) -> dict:
+        now = time.monotonic()
+        clusters = []
+        for cluster_id, process in self.processes.items():
+            received, report = self.reports.get(cluster_id, (None, {}))
+            clusters.append({
+                'cluster_id': cluster_id,
+                'shard_ids': self.ranges[cluster_id],
+                'alive': process.is_alive(),
+                'restarts': self.restarts.get(cluster_id, 0),
+                # a process that has missed a few reports is probably stuck
+                'stale': received is None or now - received > self.status_seconds * 3,
+                **report,
+            })
+        return {
+            'shard_count': self.shard_count,
+            'guilds': sum(cluster.get('guilds', 0) for cluster in clusters),
+            'users': sum(cluster.get('users', 0) for cluster in clusters),
+            'economy_users': sum(cluster.get('economy_users', 0) for cluster in clusters),
+            'clusters': clusters,
+        }
+
+    async def _serve_status(self, reader, writer) -> None:
+        writer.write(json.dumps(self.status()).encode())
+        await writer.drain()
+        writer.close()
+
+    async def _collect(self) -> None:
+        loop = asyncio.get_running_loop()
+        while not self._closing:
+            report = await loop.run_in_executor(None, self.status_queue.get)
+            if report is not None:
+                self.reports[report['cluster_id']] = (time.monotonic(), report)
+
+    def _schedule_restart(self, cluster_id: int, exitcode) -> None:
+        """Restarts within seconds after a cluster that ran for a while, backing off when it keeps dying on boot
+        (a bad token, the database being down) so it doesn't hammer the gateway and the database."""
+        now = time.monotonic()
+        if now - self._started[cluster_id] > self.max_restart_delay:
+            self._failures[cluster_id] = 0
+        failures = self._failures[cluster_id] = self._failures.get(cluster_id, 0) + 1
+        delay = min(5 * 2 ** (failures - 1), self.max_restart_delay)
+        self._restart_at[cluster_id] = now + delay
+        message = f"Cluster {cluster_id} exited with {exitcode}, restarting in {delay}s"
+        if failures > 3:
+            logger.error(f"{message}, it has failed {failures} times in a row")
+        else:
+            logger.warning(message)
+
+    async def _watch(self) -> None:
+        while not self._closing:
+            await asyncio.sleep(5)
+            for cluster_id, process in list(self.processes.items()):
+                if process.is_alive() or self._closing:
+                    continue
+                if cluster_id not in self._restart_at:
+                    self.reports.pop(cluster_id, None)
+                    self._schedule_restart(cluster_id, process.exitcode)
+                if time.monotonic() >= self._restart_at[cluster_id]:
+                    del self._restart_at[cluster_id]
+                    self.restarts[cluster_id] = self.restarts.get(cluster_id, 0) + 1
+                    self.spawn(cluster_id)
+
+    async def start(self) -> None:
+        if not self.shard_count:
+            self.shard_count = await recommended_shards(self.settings['core']['token'])
+        self.ranges = shard_ranges(self.shard_count, self.clusters)
+        if len(self.ranges) > 1 and not self.settings.get('coherence', {}).get('enabled'):
+            logger.warning("Running several clusters without [coherence] enabled, caches will go stale")
+        logger.info(f"Launching {len(self.ranges)} clusters for {self.shard_count} shards")
+
+        for cluster_id in range(len(self.ranges)):
+            self.spawn(cluster_id)
+            # identifies are rate limited anyway, this just keeps the clusters from all starting at once
+            await asyncio.sleep(5)
+
+        server = await asyncio.start_server(self._serve_status, self.host, self.port)
+        stopped = asyncio.Event()
+        try:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                asyncio.get_running_loop().add_signal_handler(sig, stopped.set)
+        except NotImplementedError:
+            pass  # windows, where ctrl+c raises KeyboardInterrupt instead
+
+        collector = asyncio.create_task(self._collect())
+        watcher = asyncio.create_task(self._watch())
+        try:
+            await stopped.wait()
+        finally:
+            self._closing = True
+            watcher.cancel()
+            server.close()
+            self.stop()
+            self.status_queue.put(None)  # wakes up the collector
+            await collector
+
+    def stop(self) -> None:
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()  # SIGTERM, which the bots handle by closing cleanly
+        for process in self.processes.values():
+            process.join(timeout=30)
+            if process.is_alive():
+                process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Mao across several processes.")
+    parser.add_argument('command', nargs='?', choices=('start', 'status'), default='start')
+    parser.add_argument('--clusters', type=int, default=0, help="processes to run, defaults to one per core")
+    parser.add_argument('--shards', type=int, default=0, help="total shards, defaults to what Discord recommends")
+    args = parser.parse_args()
+
+    with open("D:/coding/Mao/" + "/config.toml") as f:
+        settings = toml.loads(f.read())
+
+    if args.command == 'status':
+        cluster_settings = settings.get('cluster', {})
+        status = asyncio.run(
+            query_status(cluster_settings.get('status_host', '127.0.0.1'), cluster_settings.get('status_port', 8765))
+        )
+        print(json.dumps(status, indent=2))
+        return
+
+    launcher = Launcher(settings, args.clusters, args.shards)
+    try:
+        asyncio.run(launcher.start())
+    except KeyboardInterrupt:
+        launcher.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,4 @@
 import os
-import time
 from datetime import datetime
 
 import discord
@@ -19,41 +18,42 @@ intents.typing = False
 
 flags = discord.MemberCacheFlags.from_intents(intents)
 
-bot = Mao(
-    command_prefix="mao ",
-    case_insensitive=True,
-    intents=intents,
-    member_cache_flags=flags,
-    max_messages=750,
-    owner_ids={809587169520910346}
-)
-
 os.environ['JISHAKU_NO_UNDERSCORE'] = "True"
 os.environ['JISHAKU_NO_DM_TRACEBACK'] = "True"
 os.environ['JISHAKU_HIDE'] = "True"
 
 
-@bot.check_once
 async def ratelimit(ctx):
     if isinstance(ctx.command, Command) and ctx.command.cd:
         _type = 'guild' if ctx.command.cd.guild else 'user'
-        try:
-            if _type == 'guild':
-                if not ctx.guild:
-                    raise commands.NoPrivateMessage()
-                expires = bot.pool.cache['cooldowns'][_type][ctx.guild.id][ctx.author.id][ctx.command.qualified_name]
-
-            elif _type == 'user':
-                expires = bot.pool.cache['cooldowns'][_type][ctx.author.id][ctx.command.qualified_name]
-
-            if expires > time.time():
-                raise commands.CommandOnCooldown(
-                    CustomCooldownBucket(rate=1, per=ctx.command.cd.rate, type=_type),
-                    (datetime.utcfromtimestamp(expires) - datetime.utcnow()).seconds
-                )
-        except KeyError:
-            pass
+        if _type == 'guild' and not ctx.guild:
+            raise commands.NoPrivateMessage()
+
+        guild_id = ctx.guild.id if _type == 'guild' else None
+        expires = ctx.bot.pool.cooldowns.get((guild_id, ctx.author.id, ctx.command.qualified_name))
+        if expires is not None:
+            raise commands.CommandOnCooldown(
+                CustomCooldownBucket(rate=1, per=ctx.command.cd.rate, type=_type),
+                (datetime.utcfromtimestamp(expires) - datetime.utcnow()).seconds
+            )
     return True
 
+
+def create_bot(**kwargs) -> Mao:
+    """Builds the bot, ``kwargs`` being the shard and cluster options launcher.py passes to each process."""
+    bot = Mao(
+        command_prefix="mao ",
+        case_insensitive=True,
+        intents=intents,
+        member_cache_flags=flags,
+        max_messages=750,
+        owner_ids={809587169520910346},
+        **kwargs
+    )
+    bot.check_once(ratelimit)
+    return bot
+
+
 if __name__ == "__main__":
+    bot = create_bot()
     bot.run(bot.settings['core']['token'])
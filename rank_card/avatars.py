@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+
+import aiofiles
+import aiofiles.os
+
+log = logging.getLogger("AvatarCache")
+
+# avatars are drawn at 180x180, and discord only serves powers of two
+AVATAR_FETCH_SIZE = 256
+
+
+class AvatarCache:
+    """On-disk cache of downloaded avatars, addressed by the avatar hash.
+
+    Files are evicted least recently used first once the directory grows past ``max_bytes``."""
+
+    def __init__(self, path: str = 'avatar_cache', max_bytes: int = 64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._files: OrderedDict = OrderedDict()
+        self._downloads: dict = {}
+
+        os.makedirs(self.path, exist_ok=True)
+        entries = sorted(
+            (entry for entry in os.scandir(self.path) if entry.name.endswith('.png')),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in entries:
+            self._files[entry.name[:-4]] = entry.stat().st_size
+            self.size += entry.stat().st_size
+
+    @staticmethod
+    def key(user) -> str:
+        return user.avatar or f"default-{user.default_avatar.value}"
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.png")
+
+    async def fetch(self, session, user) -> bytes:
+        key = self.key(user)
+        if key in self._files:
+            try:
+                async with aiofiles.open(self._file(key), 'rb') as f:
+                    data = await f.read()
+            except FileNotFoundError:
+                self.size -= self._files.pop(key)
+            else:
+                self._files.move_to_end(key)
+                return data
+
+        # concurrent misses for the same avatar, common with the default ones, share one download and one write
+        task = self._downloads.get(key)
+        if task is None:
+            task = self._downloads[key] = asyncio.ensure_future(self._download(session, user, key))
+            task.add_done_callback(lambda _: self._downloads.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _download(self, session, user, key: str) -> bytes:
+        url = str(user.avatar_url_as(format='png', size=AVATAR_FETCH_SIZE))
+        async with session.get(url) as resp:
+            resp.raise_for_status()
+            data = await resp.read()
+        await self._store(key, data)
+        return data
+
+    async def _store(self, key: str, data: bytes) -> None:
+        if key in self._files or len(data) > self.max_bytes:
+            return
+        temp = self._file(key) + '.tmp'
+        async with aiofiles.open(temp, 'wb') as f:
+            await f.write(data)
+        await aiofiles.os.rename(temp, self._file(key))
+        if key in self._files:
+            return  # already counted
+        self._files[key] = len(data)
+        self.size += len(data)
+
+        while self.size > self.max_bytes:
+            old_key, old_size = self._files.popitem(last=False)
+            self.size -= old_size
+            try:
+                await aiofiles.os.remove(self._file(old_key))
+            except FileNotFoundError:
+                pass
+            log.debug(f"Evicted avatar {old_key}")
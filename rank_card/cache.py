@@ -0,0 +1,61 @@
+from collections import OrderedDict
+from typing import Optional
+
+from .formatting import bar_length, get_str
+
+
+class CardCache:
+    """LRU cache of finished rank card images, capped by entry count and total bytes.
+
+    Each user only ever has one entry; storing a new card for a user drops their old one."""
+
+    def __init__(self, max_entries: int = 512, max_bytes: int = 32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._cards: OrderedDict = OrderedDict()
+        self._keys: dict = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(user_id: int, avatar: Optional[str], level: int, user_xp: int, next_xp: int, user_name: str) -> tuple:
+        # only what ends up on the card matters, so xp is keyed on the rounded text and the bar width in pixels
+        return (
+            user_id, avatar, level, user_name,
+            get_str(user_xp), get_str(next_xp), int(bar_length(user_xp, next_xp))
+        )
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        data = self._cards.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self._cards.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key: tuple, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        self.invalidate(key[0])
+        self._cards[key] = data
+        self._keys[key[0]] = key
+        self.size += len(data)
+        while len(self._cards) > self.max_entries or self.size > self.max_bytes:
+            old_key, old_data = self._cards.popitem(last=False)
+            del self._keys[old_key[0]]
+            self.size -= len(old_data)
+
+    def invalidate(self, user_id: int) -> None:
+        key = self._keys.pop(user_id, None)
+        if key is not None:
+            self.size -= len(self._cards.pop(key))
+
+    def clear(self) -> None:
+        self._cards.clear()
+        self._keys.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._cards)
@@ -0,0 +1,43 @@
+from dataclasses import dataclass
+from io import BytesIO
+
+from PIL import Image
+
+# Pillow 9.1 moved the quantize methods into an enum, and 10 dropped the old constants
+FASTOCTREE = Image.Quantize.FASTOCTREE if hasattr(Image, 'Quantize') else Image.FASTOCTREE
+
+FORMATS = ('png', 'png-palette', 'webp')
+
+
+@dataclass
+class CardEncoder:
+    """How finished cards are written out.
+
+    ``png`` is a full RGBA PNG, ``png-palette`` quantizes to ``colors`` colours first and
+    ``webp`` uses ``quality``, or lossless mode when ``lossless`` is set."""
+
+    format: str = 'png'
+    compress_level: int = 6
+    optimize: bool = False
+    colors: int = 256
+    quality: int = 90
+    lossless: bool = False
+
+    def __post_init__(self):
+        if self.format not in FORMATS:
+            raise ValueError(f"Unknown card format {self.format!r}, expected one of {', '.join(FORMATS)}")
+
+    @property
+    def extension(self) -> str:
+        return 'webp' if self.format == 'webp' else 'png'
+
+    def encode(self, card: Image.Image) -> BytesIO:
+        buffer = BytesIO()
+        if self.format == 'webp':
+            card.save(buffer, 'webp', quality=self.quality, lossless=self.lossless, method=4)
+        else:
+            if self.format == 'png-palette':
+                card = card.quantize(colors=self.colors, method=FASTOCTREE)
+            card.save(buffer, 'png', compress_level=self.compress_level, optimize=self.optimize)
+        buffer.seek(0)
+        return buffer
@@ -0,0 +1,13 @@
+def get_str(xp: int) -> str:
+    if xp < 1000:
+        return str(xp)
+    if 1000 <= xp < 1000000:
+        return str(round(xp / 1000, 1)) + "k"
+    return str(round(xp / 1000000, 1)) + "M"
+
+
+def bar_length(user_xp: int, next_xp: int) -> float:
+    current_percentage = (user_xp / next_xp) * 100
+    if next_xp < user_xp:
+        current_percentage = 100
+    return (current_percentage * 4.9) + 248
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import multiprocessing
+import statistics
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from . import Generator
+from .encoding import CardEncoder
+from .template import CardTemplate
+
+log = logging.getLogger("RenderService")
+
+
+class RenderQueueFull(Exception):
+    pass
+
+
+def _warm_worker():
+    CardTemplate.get()
+
+
+def _render(encoder: CardEncoder, kwargs: dict):
+    start = time.perf_counter()
+    data = Generator(encoder=encoder).generate_profile(**kwargs).getvalue()
+    return data, time.perf_counter() - start
+
+
+class RenderService:
+    """Renders rank cards on a dedicated process pool so Pillow never holds the bot's GIL.
+
+    At most ``max_queue`` renders may be queued or running at once; anything past that
+    raises :class:`RenderQueueFull` instead of piling up."""
+
+    def __init__(self, workers: int = 2, max_queue: int = 16, encoder: CardEncoder = None):
+        self.encoder = encoder or CardEncoder()
+        self.workers = workers
+        self.max_queue = max_queue
+        self.pending = 0
+        self.rendered = 0
+        self.rejected = 0
+        self.render_times = deque(maxlen=500)
+        self.wait_times = deque(maxlen=500)
+        self.sizes = deque(maxlen=500)
+
+        # spawned rather than forked, the bot has threads of its own by now (getaddrinfo for the pool, aiohttp's
+        # resolver) and a forked child can inherit one of their locks held
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=_warm_worker
+        )
+        # the pool starts workers as jobs come in, so hand it one per worker to get them all loading the
+        # template in the background instead of on the first few cards
+        for _ in range(workers):
+            self._executor.submit(_warm_worker)
+
+    async def render(self, **kwargs) -> bytes:
+        if self.pending >= self.max_queue:
+            self.rejected += 1
+            raise RenderQueueFull()
+
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            data, elapsed = await loop.run_in_executor(self._executor, _render, self.encoder, kwargs)
+        finally:
+            self.pending -= 1
+
+        self.rendered += 1
+        self.render_times.append(elapsed)
+        self.wait_times.append(time.perf_counter() - start - elapsed)
+        self.sizes.append(len(data))
+        return data
+
+    def stats(self) -> dict:
+        def percentiles(values):
+            if len(values) < 2:
+                return {'p50': None, 'p95': None}
+            cuts = statistics.quantiles((v * 1000 for v in values), n=20)
+            return {'p50': cuts[9], 'p95': cuts[18]}
+
+        return {
+            'format': self.encoder.format,
+            'workers': self.workers,
+            'queue_depth': self.pending,
+            'max_queue': self.max_queue,
+            'rendered': self.rendered,
+            'rejected': self.rejected,
+            'render_ms': percentiles(self.render_times),
+            'wait_ms': percentiles(self.wait_times),
+            'mean_bytes': statistics.mean(self.sizes) if self.sizes else None,
+        }
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,42 @@
+import os
+import threading
+
+from PIL import Image, ImageDraw, ImageFont
+
+BLACK = (0, 0, 0)
+AVATAR_SIZE = (180, 180)
+AVATAR_POSITION = (29, 29)
+
+
+class CardTemplate:
+    """The parts of a rank card that are the same for everyone.
+
+    The background (with the empty progress bar already drawn on it), both fonts and the
+    avatar mask are decoded once, so a render only has to add the avatar, text and bar fill."""
+
+    _default = None
+    _lock = threading.Lock()
+
+    def __init__(self, background: str = None, font: str = None):
+        background = background or os.path.join('assets', 'card.jpg')
+        font = font or os.path.join('assets', 'font.ttf')
+
+        self.base = Image.open(background).convert("RGBA")
+        ImageDraw.Draw(self.base).rectangle((245, 185, 741, 205), outline=BLACK)
+
+        self.font_normal = ImageFont.truetype(font, 36)
+        self.font_small = ImageFont.truetype(font, 20)
+
+        # PIL ellipses include their end coordinates, so the mask is one pixel wider than the avatar
+        self.mask = Image.new("L", (AVATAR_SIZE[0] + 1, AVATAR_SIZE[1] + 1))
+        ImageDraw.Draw(self.mask).ellipse((0, 0, *AVATAR_SIZE), fill=255)
+        self.avatar_holder = Image.new("RGBA", self.mask.size, (255, 255, 255, 0))
+
+    @classmethod
+    def get(cls) -> 'CardTemplate':
+        """Returns the process wide template, building it on first use."""
+        if cls._default is None:
+            with cls._lock:
+                if cls._default is None:
+                    cls._default = cls()
+        return cls._default
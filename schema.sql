@@ -8,6 +8,10 @@ CREATE TABLE IF NOT EXISTS guild_config (
     welcoming BOOLEAN DEFAULT False
 );
 
+-- level curve, see utils.levels.LevelCurve
+ALTER TABLE guild_config ADD COLUMN IF NOT EXISTS level_base INTEGER NOT NULL DEFAULT 1000;
+ALTER TABLE guild_config ADD COLUMN IF NOT EXISTS level_growth REAL NOT NULL DEFAULT 1.0;
+
 CREATE TABLE IF NOT EXISTS users (
     guild_id BIGINT REFERENCES guilds ON DELETE CASCADE,
     user_id BIGINT,
@@ -19,6 +23,43 @@ CREATE TABLE IF NOT EXISTS users (
     PRIMARY KEY (guild_id, user_id)
 );
 
+-- bumped whenever a column other than xp changes, so the cache can tell which of two copies of a row is newer.
+-- XP flushes don't bump it, the cache only ever adds XP as a delta
+ALTER TABLE users ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION bump_users_version() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.version := OLD.version + 1;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS users_version ON users;
+CREATE TRIGGER users_version BEFORE UPDATE ON users
+    FOR EACH ROW WHEN (
+        (OLD.cash, OLD.vault, OLD.level, OLD.pet_name) IS DISTINCT FROM (NEW.cash, NEW.vault, NEW.level, NEW.pet_name)
+    )
+    EXECUTE FUNCTION bump_users_version();
+
+-- guilds.user_count is kept up to date by EconomyNode.register_user and unregister_user
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns WHERE table_name = 'guilds' AND column_name = 'user_count'
+    ) THEN
+        ALTER TABLE guilds ADD COLUMN user_count INTEGER NOT NULL DEFAULT 0;
+        UPDATE guilds SET user_count = counts.total
+        FROM (SELECT guild_id, COUNT(*) AS total FROM users GROUP BY guild_id) AS counts
+        WHERE guilds.guild_id = counts.guild_id;
+    END IF;
+END $$;
+
+-- leaderboard orderings, used for keyset pagination
+CREATE INDEX IF NOT EXISTS users_total_idx ON users (guild_id, (cash + vault) DESC, user_id DESC);
+CREATE INDEX IF NOT EXISTS users_cash_idx ON users (guild_id, cash DESC, user_id DESC);
+CREATE INDEX IF NOT EXISTS users_vault_idx ON users (guild_id, vault DESC, user_id DESC);
+CREATE INDEX IF NOT EXISTS users_level_idx ON users (guild_id, level DESC, xp DESC, user_id DESC);
+
 CREATE TABLE IF NOT EXISTS cooldowns (
     guild_id BIGINT REFERENCES guilds ON DELETE CASCADE DEFAULT NULL,
     user_id BIGINT,
@@ -26,6 +67,22 @@ CREATE TABLE IF NOT EXISTS cooldowns (
     expires DOUBLE PRECISION
 );
 
+-- one row per cooldown, guild_id being NULL for user cooldowns, see utils.cooldowns.CooldownStore
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'cooldowns_guild_key') THEN
+        DELETE FROM cooldowns WHERE expires < extract(epoch FROM now());
+        DELETE FROM cooldowns WHERE ctid NOT IN (
+            SELECT DISTINCT ON (guild_id, user_id, command) ctid
+            FROM cooldowns
+            ORDER BY guild_id, user_id, command, expires DESC
+        );
+        CREATE UNIQUE INDEX cooldowns_guild_key ON cooldowns (guild_id, user_id, command) WHERE guild_id IS NOT NULL;
+    END IF;
+END $$;
+CREATE UNIQUE INDEX IF NOT EXISTS cooldowns_user_key ON cooldowns (user_id, command) WHERE guild_id IS NULL;
+CREATE INDEX IF NOT EXISTS cooldowns_expires_idx ON cooldowns (expires);
+
 CREATE TABLE IF NOT EXISTS welcome (
     guild_id BIGINT PRIMARY KEY REFERENCES guilds ON DELETE CASCADE NOT NULL,
     embed BOOLEAN DEFAULT False,
@@ -53,5 +110,82 @@ CREATE TABLE IF NOT EXISTS tag_search (
     owner_id BIGINT,
     created_at TIMESTAMP DEFAULT timezone('UTC'::text, now()),
     name VARCHAR(256)
-)
+);
+
+-- change events for utils.coherence.CacheListener, published on the mao_cache channel
+CREATE OR REPLACE FUNCTION notify_users_change() RETURNS TRIGGER AS $$
+DECLARE
+    target users;
+    fields JSONB;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        target := OLD;
+        fields := '{}';
+    ELSIF TG_OP = 'INSERT' THEN
+        target := NEW;
+        fields := jsonb_build_object(
+            'cash', NEW.cash, 'vault', NEW.vault, 'pet_name', NEW.pet_name, 'xp', NEW.xp, 'level', NEW.level,
+            'version', NEW.version
+        );
+    ELSE
+        -- the row as of this version, except XP which is a delta since the cache holds XP the table doesn't yet
+        target := NEW;
+        fields := '{}';
+        IF NEW.version <> OLD.version THEN
+            fields := jsonb_build_object(
+                'cash', NEW.cash, 'vault', NEW.vault, 'pet_name', NEW.pet_name, 'level', NEW.level,
+                'version', NEW.version
+            );
+        END IF;
+        IF NEW.xp <> OLD.xp THEN
+            fields := fields || jsonb_build_object('xp', NEW.xp - OLD.xp);
+        END IF;
+        IF fields = '{}' THEN
+            RETURN NULL;
+        END IF;
+    END IF;
+    PERFORM pg_notify('mao_cache', json_build_object(
+        'origin', current_setting('application_name'), 'xid', txid_current(), 'table', TG_TABLE_NAME,
+        'op', left(TG_OP, 1), 'guild_id', target.guild_id, 'user_id', target.user_id, 'fields', fields
+    )::TEXT);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION notify_guild_config_change() RETURNS TRIGGER AS $$
+DECLARE
+    target guild_config;
+BEGIN
+    target := CASE WHEN TG_OP = 'DELETE' THEN OLD ELSE NEW END;
+    PERFORM pg_notify('mao_cache', json_build_object(
+        'origin', current_setting('application_name'), 'xid', txid_current(), 'table', TG_TABLE_NAME,
+        'op', left(TG_OP, 1), 'guild_id', target.guild_id,
+        'fields', to_jsonb(target) - 'guild_id'
+    )::TEXT);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- only new and extended cooldowns, expired rows get deleted in bulk and every process drops those on its own
+CREATE OR REPLACE FUNCTION notify_cooldowns_change() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('mao_cache', json_build_object(
+        'origin', current_setting('application_name'), 'xid', txid_current(), 'table', TG_TABLE_NAME,
+        'op', left(TG_OP, 1), 'guild_id', NEW.guild_id, 'user_id', NEW.user_id,
+        'command', NEW.command, 'expires', NEW.expires
+    )::TEXT);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS users_notify ON users;
+CREATE TRIGGER users_notify AFTER INSERT OR UPDATE OR DELETE ON users
+    FOR EACH ROW EXECUTE FUNCTION notify_users_change();
+
+DROP TRIGGER IF EXISTS guild_config_notify ON guild_config;
+CREATE TRIGGER guild_config_notify AFTER INSERT OR UPDATE OR DELETE ON guild_config
+    FOR EACH ROW EXECUTE FUNCTION notify_guild_config_change();
 
+DROP TRIGGER IF EXISTS cooldowns_notify ON cooldowns;
+CREATE TRIGGER cooldowns_notify AFTER INSERT OR UPDATE ON cooldowns
+    FOR EACH ROW EXECUTE FUNCTION notify_cooldowns_change();
@@ -2,15 +2,26 @@ import argparse
 import asyncio
 import logging
 import os
+import time
 
 import aiohttp
 import discord
 import toml
 from discord.ext import commands, menus
 
+import core
+from utils.cluster import report_status, shard_filter
+from utils.coherence import ORIGIN, CacheListener, set_triggers
 from utils.context import CustomContext
 from utils.db import *
 from utils.errors import NotRegistered
+from utils.journal import XPJournal
+from utils import metrics
+from utils.migrations import migrate
+from utils.names import NameResolver
+from utils.profiler import CommandProfiler
+from utils.queries import current_command
+from utils.snapshot import Snapshot, read_snapshot, write_snapshot
 from utils.timer import Timer
 
 try:
@@ -28,8 +39,12 @@ logging.basicConfig(
 )
 
 
-class Mao(commands.Bot):
+class Mao(commands.AutoShardedBot):
     def __init__(self, *args, **kwargs):
+        # set by launcher.py when this process is one of several, each connecting its own shard_ids
+        self.cluster_id: int = kwargs.pop('cluster_id', None)
+        self._status_queue = kwargs.pop('status_queue', None)
+        self.started = time.monotonic()
         super().__init__(*args, **kwargs)
         self._BotBase__cogs = commands.core._CaseInsensitiveDict()
 
@@ -42,8 +57,16 @@ class Mao(commands.Bot):
         self.loop = asyncio.get_event_loop()
         self._prepped = asyncio.Event()
         self.pool: Manager = self.loop.run_until_complete(
-            create_pool(bot=self, dsn=self.settings['core']['postgres_dsn'], loop=self.loop)
+            create_pool(
+                bot=self,
+                dsn=self.settings['core']['postgres_dsn'],
+                loop=self.loop,
+                server_settings={'application_name': ORIGIN}
+            )
         )
+        self.cache_listener = None
+        if self.settings.get('coherence', {}).get('enabled'):
+            self.cache_listener = CacheListener(self, self.settings['core']['postgres_dsn'])
         
         self.loop.create_task(self.__prep())
 
@@ -55,12 +78,20 @@ class Mao(commands.Bot):
                 'welcoming': set()
             }
         }
+        self.names = NameResolver(self)
         self.non_leveling_guilds: set = set()
         self.registered_users: set = set()
         self._cd = commands.CooldownMapping.from_cooldown(5, 5, commands.BucketType.user)
+        self.profiler = CommandProfiler(self.settings.get('profiler', {}).get('window', 512))
+        self.before_invoke(self._before_callback)
+        self.after_invoke(self._after_callback)
 
         # management stuff
         self.encrypt_key = self.settings['misc']['encrypt_key'].encode('utf-8')
+        self.xp_journal = XPJournal(self.cluster_path(self.settings.get('economy', {}).get('journal_path', 'xp_journal')))
+        self.snapshot_settings: dict = self.settings.get('snapshot', {})
+        self.metrics_settings: dict = self.settings.get('metrics', {})
+        self._metrics_shutdown = asyncio.Event()
 
         #  bot management
         self.maintenance = False
@@ -71,32 +102,182 @@ class Mao(commands.Bot):
         self.error_webhook = discord.Webhook.from_url(
             self.settings["core"]["error_webhook"],
             adapter=discord.AsyncWebhookAdapter(self.session)
-        )       
+        )
+        timings = {}
         async with self.pool.acquire() as conn:
-            with open("D:/coding/Mao/" + "schema.sql") as f:
-                    await conn.execute(f.read())
-            await self.wait_until_ready()
-            users = await conn.fetch("SELECT user_id FROM users")
-            self.cache['registered_users'] = {user["user_id"] for user in users}
-
-            await conn.executemany(
-                "INSERT INTO guilds (guild_id) VALUES ($1) ON CONFLICT DO NOTHING",
-                tuple((g.id,) for g in self.guilds)
+            with Timer() as timings['schema']:
+                if await migrate(conn, "D:/coding/Mao/" + "schema.sql"):
+                    # statements prepared against the old schema, see utils.statements
+                    await self.pool.expire_connections()
+                await set_triggers(conn, self.cache_listener is not None)
+            if self.cache_listener:
+                with Timer() as timings['listen']:
+                    await self.cache_listener.start()
+            with Timer() as timings['xp replay']:
+                pending_xp = self.xp_journal.replay()
+                if pending_xp:
+                    await self.pool.economy.flush_xp(pending_xp, conn=conn)
+                    logger.info(f"Replayed journaled XP for {len(pending_xp)} users")
+                self.xp_journal.finish_replay()
+            with Timer() as timings['snapshot']:
+                snapshot = await self.restore_snapshot(conn)
+            with Timer() as timings['ready']:
+                await self.wait_until_ready()
+            with Timer() as timings['registered users']:
+                users = await conn.fetch("SELECT DISTINCT user_id FROM users")
+                self.cache['registered_users'] = {user["user_id"] for user in users}
+
+            with Timer() as timings['guild sync']:
+                query = (
+                    """
+                    WITH ids AS (
+                        SELECT DISTINCT unnest($1::BIGINT[]) AS guild_id
+                    ), new_guilds AS (
+                        INSERT INTO guilds (guild_id)
+                        SELECT ids.guild_id FROM ids
+                        WHERE NOT EXISTS (SELECT 1 FROM guilds WHERE guilds.guild_id = ids.guild_id)
+                        ON CONFLICT (guild_id) DO NOTHING
+                    )
+                    INSERT INTO guild_config (guild_id)
+                    SELECT ids.guild_id FROM ids
+                    WHERE NOT EXISTS (SELECT 1 FROM guild_config WHERE guild_config.guild_id = ids.guild_id)
+                    -- the filters skip most rows cheaply, but another process or on_guild_join can race them
+                    ON CONFLICT (guild_id) DO NOTHING
+                    """
+                )
+                await conn.execute(query, [g.id for g in self.guilds])
+
+            with Timer() as timings['guild config']:
+                if snapshot and snapshot.non_leveling is not None:
+                    self.cache['guilds']['non_leveling'] = snapshot.non_leveling
+                    self.cache['guilds']['welcoming'] = snapshot.welcoming
+                else:
+                    await self.load_guild_flags(conn)
+            self._prepped.set()
+            if self.metrics_settings.get('enabled'):
+                self.start_metrics()
+            if self._status_queue is not None:
+                self.loop.create_task(
+                    report_status(self, self._status_queue, self.settings.get('cluster', {}).get('status_seconds', 10))
+                )
+            breakdown = ", ".join(f"{phase}: {timer.ms:.1f}ms" for phase, timer in timings.items())
+            logger.info(f"Finished prep ({breakdown})")
+
+    @property
+    def shard_params(self) -> tuple:
+        """(shard count, shard ids) for :func:`utils.cluster.shard_filter`, both None outside a cluster."""
+        if self.cluster_id is None:
+            return None, None
+        return self.shard_count, list(self.shard_ids)
+
+    def cluster_path(self, path: str) -> str:
+        """Files a process keeps to itself, like the XP journal, get the cluster id appended."""
+        return path if self.cluster_id is None else f"{path}.{self.cluster_id}"
+
+    def start_metrics(self):
+        metrics.registry.collector(self.collect_metrics)
+        # every process of a cluster gets its own port
+        port = self.metrics_settings.get('port', 9100) + (self.cluster_id or 0)
+        self.loop.create_task(metrics.serve(self.metrics_settings.get('host', '127.0.0.1'), port, self._metrics_shutdown))
+        self.loop.create_task(metrics.measure_loop_lag(self))
+
+    def collect_metrics(self):
+        connected, in_use = self.pool.connection_stats()
+        metrics.POOL_CONNECTIONS.set(connected)
+        metrics.POOL_IN_USE.set(in_use)
+        metrics.GATEWAY_LATENCY.clear()
+        for shard_id, latency in self.latencies:
+            metrics.GATEWAY_LATENCY.set(latency, shard=shard_id)
+        metrics.ECONOMY_USERS.set(self.pool.economy.users)
+        if economy := self.get_cog('Economy'):
+            metrics.RENDER_QUEUE.set(economy.renderer.pending)
+
+    async def load_guild_flags(self, conn=None):
+        guilds = await (conn or self.pool).fetch(
+            "SELECT guild_id, leveling, welcoming FROM guild_config "
+            f"WHERE (NOT leveling OR welcoming) AND {shard_filter('guild_id', 1)}",
+            *self.shard_params
+        )
+        non_leveling, welcoming = set(), set()
+        for g in guilds:
+            if not g['leveling']:
+                non_leveling.add(g['guild_id'])
+            if g['welcoming']:
+                welcoming.add(g['guild_id'])
+        self.cache['guilds']['non_leveling'] = non_leveling
+        self.cache['guilds']['welcoming'] = welcoming
+
+    async def restore_snapshot(self, conn):
+        """Loads the caches saved by the last clean shutdown, keeping only the parts that still match the database."""
+        if not self.snapshot_settings.get('enabled'):
+            return None
+        path = self.cluster_path(self.snapshot_settings.get('path', 'cache.snapshot'))
+        snapshot = read_snapshot(path)
+        if snapshot is None:
+            return None
+        # a snapshot is only good for the restart straight after it was written
+        os.remove(path)
+
+        restored = await self.pool.economy.restore_snapshot(snapshot.economy, conn)
+        cooldowns = self.pool.restore_cooldowns(snapshot.cooldowns)
+        query = (
+            """
+            SELECT
+                COUNT(*) FILTER (WHERE NOT leveling), COALESCE(SUM(guild_id) FILTER (WHERE NOT leveling), 0),
+                COUNT(*) FILTER (WHERE welcoming), COALESCE(SUM(guild_id) FILTER (WHERE welcoming), 0)
+            FROM guild_config
+            WHERE {}
+            """
+        ).format(shard_filter('guild_id', 1))
+        flags = (len(snapshot.non_leveling), sum(snapshot.non_leveling), len(snapshot.welcoming), sum(snapshot.welcoming))
+        if tuple(await conn.fetchrow(query, *self.shard_params)) != flags:
+            snapshot.non_leveling = snapshot.welcoming = None
+        logger.info(
+            f"Restored {restored}/{len(snapshot.economy)} guilds from the snapshot "
+            f"({cooldowns} cooldowns, "
+            f"guild config {'restored' if snapshot.non_leveling is not None else 'stale'})"
+        )
+        return snapshot
+
+    def write_snapshot(self):
+        snapshot = Snapshot(
+            economy=dict(self.pool.economy.cache),
+            cooldowns=self.pool.cooldown_entries(),
+            non_leveling=self.cache['guilds']['non_leveling'],
+            welcoming=self.cache['guilds']['welcoming']
+        )
+        write_snapshot(self.cluster_path(self.snapshot_settings.get('path', 'cache.snapshot')), snapshot)
+        logger.info(f"Wrote a snapshot of {len(snapshot.economy)} guilds")
+
+    async def invoke(self, ctx):
+        if ctx.command is None:
+            return await super().invoke(ctx)
+        started = time.perf_counter()
+        token = current_command.set(ctx.command.qualified_name)
+        try:
+            await super().invoke(ctx)
+        finally:
+            current_command.reset(token)
+            elapsed = time.perf_counter() - started
+            metrics.COMMAND_LATENCY.observe(
+                elapsed,
+                command=ctx.command.qualified_name,
+                status='error' if ctx.command_failed else 'ok'
             )
+            if isinstance(ctx.command, core.Command) and 'callback' in ctx.timings:
+                ctx.timings['total'] = elapsed
+                self.profiler.record(ctx.command.qualified_name, ctx.timings)
 
-            await conn.executemany(
-                "INSERT INTO guild_config (guild_id) VALUES ($1) ON CONFLICT DO NOTHING",
-                tuple((g.id,) for g in self.guilds)
-            )
+    async def _before_callback(self, ctx):
+        ctx._callback_started = (time.perf_counter(), ctx.timings.get('reply', 0.0))
 
-            guilds = await conn.fetch("SELECT * FROM guild_config")
-            for g in guilds:
-                if not g['leveling']:
-                    self.cache['guilds']['non_leveling'].add(g['guild_id'])
-                if g['welcoming']:
-                    self.cache['guilds']['welcoming'].add(g['guild_id'])
-            self._prepped.set()
-            logger.info("Finished prep")
+    async def _after_callback(self, ctx):
+        # what the callback spent sending messages counts as reply, not callback
+        started, replied = getattr(ctx, '_callback_started', (None, 0.0))
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started - (ctx.timings.get('reply', 0.0) - replied)
+        ctx.timings['callback'] = ctx.timings.get('callback', 0.0) + elapsed
 
     async def on_ready(self):
         logger.info("Connected to Discord.")
@@ -131,6 +312,19 @@ class Mao(commands.Bot):
         super().run(*args, **kwargs)
 
     async def close(self):
+        if self.snapshot_settings.get('enabled') and self._prepped.is_set():
+            try:
+                self.write_snapshot()
+            except Exception:
+                logger.exception("Failed to write the cache snapshot")
+        self.xp_journal.close()
+        try:
+            await self.pool.flush_cooldowns()
+        except Exception:
+            logger.exception("Failed to write cooldowns")
+        self._metrics_shutdown.set()
+        if self.cache_listener:
+            await self.cache_listener.close()
         await self.session.close()
         await self.pool.close()
         await super().close()
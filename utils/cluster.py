@@ -0,0 +1,63 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger("Cluster")
+
+
+def shard_ranges(shard_count: int, clusters: int) -> list:
+    """Splits shard ids into ``clusters`` contiguous, near equal ranges."""
+    clusters = max(1, min(clusters, shard_count))
+    size, extra = divmod(shard_count, clusters)
+    ranges, start = [], 0
+    for cluster_id in range(clusters):
+        stop = start + size + (cluster_id < extra)
+        ranges.append(list(range(start, stop)))
+        start = stop
+    return ranges
+
+
+def shard_filter(column: str, first_param: int) -> str:
+    """SQL that keeps rows of guilds on this process' shards, given ($n shard count, $n+1 shard ids).
+
+    The shard count is NULL when running unsharded, which keeps everything."""
+    count, ids = f"${first_param}", f"${first_param + 1}"
+    return f"({count}::INTEGER IS NULL OR ({column} >> 22) % {count}::INTEGER = ANY({ids}::INTEGER[]))"
+
+
+def cluster_status(bot) -> dict:
+    economy = bot.pool.economy.stats()
+    return {
+        'cluster_id': bot.cluster_id,
+        'pid': os.getpid(),
+        'shard_ids': list(bot.shard_ids or []),
+        'ready': bot.is_ready(),
+        'uptime': time.monotonic() - bot.started,
+        'guilds': len(bot.guilds),
+        'users': len(bot.users),
+        'latencies': {shard_id: round(latency * 1000, 2) for shard_id, latency in bot.latencies},
+        'economy_guilds': economy['guilds'],
+        'economy_users': economy['users'],
+        'cooldowns': len(bot.pool.cooldowns),
+    }
+
+
+async def report_status(bot, queue, interval: float) -> None:
+    """Sends :func:`cluster_status` to the launcher every ``interval`` seconds."""
+    while not bot.is_closed():
+        try:
+            queue.put_nowait(cluster_status(bot))
+        except Exception:
+            logger.exception("Failed to report cluster status")
+        await asyncio.sleep(interval)
+
+
+async def query_status(host: str, port: int) -> dict:
+    """Asks the launcher's status server for every cluster's last report."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        return json.loads(await reader.read())
+    finally:
+        writer.close()
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+
+import asyncpg
+
+logger = logging.getLogger("Coherence")
+
+CHANNEL = 'mao_cache'
+# every pool connection reports this as its application_name, which the triggers in schema.sql copy
+# into each event so a process can skip the changes it made itself
+ORIGIN = f"mao:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# (table, trigger) for every trigger in schema.sql that publishes on CHANNEL
+NOTIFY_TRIGGERS = (
+    ('users', 'users_notify'),
+    ('guild_config', 'guild_config_notify'),
+    ('cooldowns', 'cooldowns_notify'),
+)
+
+
+async def set_triggers(conn, enabled: bool) -> None:
+    """Turns the notify triggers on or off to match ``[coherence] enabled``. Left on with nobody listening,
+    every XP flush would still pay for a ``pg_notify`` per user."""
+    query = "SELECT tgname, tgenabled <> 'D' AS enabled FROM pg_trigger WHERE tgname = ANY($1::TEXT[])"
+    current = {row['tgname']: row['enabled'] for row in await conn.fetch(query, [name for _, name in NOTIFY_TRIGGERS])}
+    for table, trigger in NOTIFY_TRIGGERS:
+        if current.get(trigger, enabled) != enabled:
+            await conn.execute(f"ALTER TABLE {table} {'ENABLE' if enabled else 'DISABLE'} TRIGGER {trigger}")
+
+
+class LoadSnapshot:
+    """The transactions a guild load could see, parsed from ``txid_current_snapshot()``.
+
+    An event from a transaction the load already saw must not be applied on top of it again."""
+
+    __slots__ = ('xmin', 'xmax', 'xip')
+
+    def __init__(self, text: str):
+        xmin, xmax, xip = text.split(':')
+        self.xmin = int(xmin)
+        self.xmax = int(xmax)
+        self.xip = frozenset(int(xid) for xid in xip.split(',') if xid)
+
+    def saw(self, xid: int) -> bool:
+        return xid < self.xmin or (xid < self.xmax and xid not in self.xip)
+
+
+class CacheListener:
+    """Applies the change events published by the triggers in schema.sql to this process' caches.
+
+    Users are sent as their row at a version, which EconomyNode only applies when it hasn't seen a newer
+    one, so events and the rows returned by this process' own updates can arrive in any order. XP is sent
+    as a delta instead, since the cached XP includes some that is still waiting for a flush. Events for a guild
+    that is being loaded are held until the load finishes, then applied unless the load's snapshot saw them."""
+
+    def __init__(self, bot, dsn: str):
+        self.bot = bot
+        self.dsn = dsn
+        self.conn = None
+        self.events = 0
+        self._closed = False
+
+    async def start(self) -> None:
+        self.conn = await asyncpg.connect(self.dsn)
+        self.conn.add_termination_listener(self._on_termination)
+        await self.conn.add_listener(CHANNEL, self._on_notify)
+        logger.info(f"Listening for cache changes as {ORIGIN}")
+
+    async def close(self) -> None:
+        self._closed = True
+        if self.conn is not None and not self.conn.is_closed():
+            await self.conn.close()
+
+    def _on_termination(self, conn) -> None:
+        if not self._closed:
+            self.bot.loop.create_task(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        delay = 1
+        while not self._closed:
+            try:
+                await self.start()
+            except (OSError, asyncpg.PostgresError):
+                logger.warning(f"Couldn't reconnect the cache listener, retrying in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+            else:
+                break
+        # anything published while we weren't listening is lost, so start over from the database
+        await self.resync()
+
+    async def resync(self) -> None:
+        economy = self.bot.pool.economy
+        for guild_id in list(economy.cache):
+            economy.evict(guild_id)
+        await self.bot.pool.prepare_cache()
+        await self.bot.load_guild_flags()
+
+    def _on_notify(self, conn, pid: int, channel: str, payload: str) -> None:
+        event = json.loads(payload)
+        if event['origin'] == ORIGIN:
+            return
+        self.events += 1
+        try:
+            getattr(self, f"_apply_{event['table']}")(event)
+        except Exception:
+            logger.exception(f"Failed to apply cache event {payload}")
+
+    def _apply_users(self, event: dict) -> None:
+        if event['op'] == 'I':
+            self.bot.cache['registered_users'].add(event['user_id'])
+        self.bot.pool.economy.apply(event['guild_id'], event['user_id'], event['op'], event['fields'], event['xid'])
+
+    def _apply_guild_config(self, event: dict) -> None:
+        guild_id, fields = event['guild_id'], event['fields']
+        flags = self.bot.cache['guilds']
+        if event['op'] == 'D':
+            flags['non_leveling'].discard(guild_id)
+            flags['welcoming'].discard(guild_id)
+            self.bot.pool.cache.get(guild_id, {}).pop('guild_config', None)
+            return
+        (flags['non_leveling'].discard if fields['leveling'] else flags['non_leveling'].add)(guild_id)
+        (flags['welcoming'].add if fields['welcoming'] else flags['welcoming'].discard)(guild_id)
+        self.bot.pool.cache.setdefault(guild_id, {})['guild_config'] = fields
+
+    def _apply_cooldowns(self, event: dict) -> None:
+        if event['op'] != 'D':
+            self.bot.pool.cooldowns.load([(event['guild_id'], event['user_id'], event['command'], event['expires'])])
@@ -1,9 +1,22 @@
 import asyncio
+import time
 
 from discord.ext import commands
 
 
 class CustomContext(commands.Context):
+    def __init__(self, **attrs):
+        super().__init__(**attrs)
+        # seconds spent in each phase of the invoke, see utils.profiler
+        self.timings: dict = {}
+
+    async def send(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().send(*args, **kwargs)
+        finally:
+            self.timings['reply'] = self.timings.get('reply', 0.0) + time.perf_counter() - started
+
     def escape(self, text: str):
         mark = [
             '`',
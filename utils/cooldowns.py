@@ -0,0 +1,68 @@
+import time
+
+
+class CooldownStore:
+    """Live command cooldowns keyed by ``(guild_id, user_id, command)``, guild_id being None for user cooldowns.
+
+    Every key is also filed in a timing wheel under the second it expires, so purging only touches the
+    buckets that have come due and the entries in them, never the cooldowns that are still running."""
+
+    def __init__(self):
+        self._expires = {}
+        self._wheel = {}
+        self._cursor = int(time.time())
+
+    def __len__(self):
+        return len(self._expires)
+
+    @staticmethod
+    def key(guild_id, user_id: int, command: str) -> tuple:
+        return guild_id, user_id, command
+
+    def get(self, key: tuple):
+        """When a cooldown expires, or None if it isn't running."""
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.time():
+            return None
+        return expires
+
+    def set(self, key: tuple, expires: float) -> None:
+        self.purge()
+        if expires <= time.time():
+            self._expires.pop(key, None)
+            return
+        self._expires[key] = expires
+        self._wheel.setdefault(int(expires), []).append(key)
+
+    def load(self, entries) -> None:
+        """Fills the store from (guild_id, user_id, command, expires) rows, keeping the later expiry of duplicates."""
+        for guild_id, user_id, command, expires in entries:
+            key = (guild_id, user_id, command)
+            if self._expires.get(key, 0) < expires:
+                self.set(key, expires)
+
+    def purge(self, now: float = None) -> int:
+        now = int(time.time() if now is None else now)
+        if now < self._cursor:
+            return 0
+        # after a long gap it's cheaper to look at the buckets that exist than every second in between
+        if now - self._cursor > len(self._wheel):
+            ticks = sorted(tick for tick in self._wheel if tick < now)
+        else:
+            ticks = range(self._cursor, now)
+        self._cursor = now
+
+        removed = 0
+        for tick in ticks:
+            for key in self._wheel.pop(tick, ()):
+                # a key that was set again is filed under its newer second as well, leave that one be
+                expires = self._expires.get(key)
+                if expires is not None and int(expires) == tick:
+                    del self._expires[key]
+                    removed += 1
+        return removed
+
+    def entries(self) -> list:
+        """Every running cooldown as (guild_id, user_id, command, expires)."""
+        self.purge()
+        return [(*key, expires) for key, expires in self._expires.items()]
@@ -1,95 +1,348 @@
+import asyncio
 import json
+import time
 import typing
-from collections import defaultdict
+from collections import OrderedDict
 
 import asyncpg
 
+from utils.cluster import shard_filter
+from utils.coherence import LoadSnapshot
 from utils.context import CustomContext
-from utils.errors import NotRegistered
+from utils.cooldowns import CooldownStore
+from utils.errors import InsufficientFunds, NotRegistered
+from utils import metrics
+from utils.levels import LevelCurve, get_curve
+from utils.queries import InstrumentedConnection, stats as query_stats
+from utils.ranking import GuildRanking
+from utils.records import UserRecord
+from utils.snapshot import economy_checksum
+from utils.statements import prepare_statements
 from .__init__ import Mao
 
 
 
 class EconomyNode:
+    """Write-through cache of the users table, loaded one guild at a time.
+
+    A guild's users are fetched the first time something in that guild needs them. Guilds
+    that have been idle for ``idle_seconds`` are dropped, and so are the least recently used
+    ones once more than ``max_users`` users are cached. Guilds with XP that hasn't been
+    flushed yet are never dropped."""
+
     def __init__(self, db: 'Manager', bot: Mao):
         self.bot: Mao = bot
         self.pool: Manager = db
-        self.cache: dict = {}
-        self.bot.loop.create_task(self._prepare_cache())
+        self.cache: OrderedDict = OrderedDict()
+        self.rankings: dict = {}
+        self._loading: dict = {}
+        self._last_used: dict = {}
+        self._unflushed: dict = {}
+        self._load_snapshots: dict = {}
+        self._pending_events: dict = {}
+        self._row_versions: dict = {}
+
+        settings = self.bot.settings.get('economy', {})
+        self.max_users: int = settings.get('cache_max_users', 500000)
+        self.idle_seconds: float = settings.get('cache_idle_seconds', 1800)
+        self.users = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bot.loop.create_task(self._evict_loop())
+
+    async def _load(self, guild_id: int) -> dict:
+        try:
+            async with self.pool.acquire() as conn:
+                # one snapshot for both, so CacheListener events the rows already include can be told apart
+                async with conn.transaction(isolation='repeatable_read', readonly=True):
+                    snapshot = await conn.fetchval("SELECT txid_current_snapshot()::text")
+                    rows = await conn.fetch("SELECT * FROM users WHERE guild_id = $1", guild_id)
+            users = {user['user_id']: UserRecord.from_row(user) for user in rows}
+            self.cache[guild_id] = users
+            self._load_snapshots[guild_id] = LoadSnapshot(snapshot)
+            self.rankings[guild_id] = GuildRanking.build(users)
+            self.users += len(users)
+        finally:
+            events = self._pending_events.pop(guild_id, ())
+        # events that arrived while the rows were being fetched, apply skips the ones the rows already include
+        for event in events:
+            self.apply(guild_id, *event)
+        return users
+
+    async def guild(self, guild_id: int) -> dict:
+        """Every cached user of a guild, loading them first if needed."""
+        self._last_used[guild_id] = time.monotonic()
+        if (users := self.cache.get(guild_id)) is not None:
+            self.hits += 1
+            self.cache.move_to_end(guild_id)
+            return users
 
-    async def _prepare_cache(self) -> None:
+        self.misses += 1
+        # concurrent commands in a cold guild all wait on the same load
+        task = self._loading.get(guild_id)
+        if task is None:
+            task = self._loading[guild_id] = self.bot.loop.create_task(self._load(guild_id))
+            task.add_done_callback(lambda _: self._loading.pop(guild_id, None))
+        return await asyncio.shield(task)
+
+    def evict(self, guild_id: int) -> bool:
+        if guild_id in self._unflushed or guild_id in self._loading:
+            return False
+        users = self.cache.pop(guild_id, None)
+        if users is None:
+            return False
+        self.rankings.pop(guild_id, None)
+        self._last_used.pop(guild_id, None)
+        self._load_snapshots.pop(guild_id, None)
+        self.users -= len(users)
+        self.evictions += 1
+        return True
+
+    def evict_idle(self) -> None:
+        now = time.monotonic()
+        for guild_id in list(self.cache):
+            if now - self._last_used.get(guild_id, 0) > self.idle_seconds:
+                self.evict(guild_id)
+
+        # least recently used first, but leave anything touched in the last minute alone
+        for guild_id in list(self.cache):
+            if self.users <= self.max_users:
+                break
+            if now - self._last_used.get(guild_id, 0) > 60:
+                self.evict(guild_id)
+
+        # anything older than these was delivered long ago, and every later copy of the row has a higher version
+        for key, (seen, _) in list(self._row_versions.items()):
+            if now - seen > 60:
+                del self._row_versions[key]
+
+    async def _evict_loop(self) -> None:
         await self.bot.wait_until_ready()
-        self.cache = {guild.id: {} for guild in self.bot.guilds}
-        user_data = await self.pool.fetch("SELECT * FROM users")
-        for user in user_data:
-            data = dict(user)
-            self.cache[data.pop('guild_id')].update({data.pop('user_id'): data})
+        while not self.bot.is_closed():
+            await asyncio.sleep(60)
+            self.evict_idle()
+
+    def restore(self, guild_id: int, users: dict) -> None:
+        """Caches a guild's users from somewhere other than the database, like a snapshot."""
+        if guild_id in self.cache:
+            return
+        self.cache[guild_id] = users
+        self.rankings[guild_id] = GuildRanking.build(users)
+        self._last_used[guild_id] = time.monotonic()
+        self.users += len(users)
 
-    def from_cache(self, guild_id, user_id) -> dict:
+    async def restore_snapshot(self, economy: dict, conn) -> int:
+        """Restores every guild from a snapshot that still matches the database. Returns how many did."""
+        query = (
+            """
+            SELECT
+                guild_id, COUNT(*), SUM(user_id), SUM(cash), SUM(vault), SUM(xp), SUM(level),
+                SUM(COALESCE(length(pet_name), 0))
+            FROM users WHERE guild_id = ANY($1::BIGINT[])
+            GROUP BY guild_id
+            """
+        )
+        current = {row[0]: tuple(row[1:]) for row in await conn.fetch(query, list(economy))}
+        restored = 0
+        for guild_id, users in economy.items():
+            # guilds without users don't come back from the query at all
+            if current.get(guild_id, (0,) * 7) == economy_checksum(users):
+                self.restore(guild_id, users)
+                restored += 1
+        return restored
+
+    def apply(self, guild_id: int, user_id: int, op: str, fields: dict, xid: int) -> None:
+        """Applies a change another process made to the users table, see :class:`utils.coherence.CacheListener`.
+
+        Changes to a guild that is still loading are held until its rows are in, since the change may have
+        committed after the load's snapshot and so be missing from them."""
+        users = self.cache.get(guild_id)
+        if users is None:
+            if guild_id in self._loading:
+                self._pending_events.setdefault(guild_id, []).append((user_id, op, fields, xid))
+            return  # otherwise the next load reads it from the table
+        snapshot = self._load_snapshots.get(guild_id)
+        if snapshot is not None and snapshot.saw(xid):
+            return
+
+        if op == 'D':
+            self._row_versions.pop((guild_id, user_id), None)
+            if users.pop(user_id, None) is not None:
+                self.users -= 1
+                self.rankings[guild_id].remove(user_id)
+            return
+        if op == 'I':
+            self._row_versions.pop((guild_id, user_id), None)
+            if user_id not in users:
+                self.users += 1
+            users[user_id] = UserRecord.from_row(fields)
+            self.rerank(guild_id, user_id)
+        elif user_id in users:
+            if 'version' in fields:
+                self._set_row(guild_id, user_id, fields)
+            if xp := fields.get('xp'):
+                users[user_id]['xp'] += xp
+                self.rerank(guild_id, user_id)
+
+    def stats(self) -> dict:
+        return {
+            'guilds': len(self.cache),
+            'users': self.users,
+            'max_users': self.max_users,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def from_cache(self, guild_id, user_id) -> UserRecord:
         ret = self.cache.get(guild_id, {}).get(user_id, {})
         return ret or None
 
-    async def get_user(self, ctx, user_id=None) -> dict:
+    def rerank(self, guild_id, user_id) -> None:
+        """Moves a user to their new place on the leaderboards after their cached balance changed."""
+        if (data := self.from_cache(guild_id, user_id)) and guild_id in self.rankings:
+            self.rankings[guild_id].update(user_id, data)
+
+    async def add_xp(self, guild_id: int, user_id: int, xp: int) -> bool:
+        """Adds XP to the cache only, pinning the guild until :meth:`flushed` says it is in the database."""
+        users = await self.guild(guild_id)
+        if user_id not in users:
+            return False
+        users[user_id]['xp'] += xp
+        self.rerank(guild_id, user_id)
+        self._unflushed[guild_id] = time.monotonic()
+        return True
+
+    def flushed(self, since: float) -> None:
+        """Unpins guilds whose XP was all taken by a flush that started at ``since``."""
+        for guild_id, last in list(self._unflushed.items()):
+            if last <= since:
+                del self._unflushed[guild_id]
+
+    async def get_user(self, ctx, user_id=None) -> UserRecord:
         user_id = user_id or ctx.author.id
-        if cached := self.from_cache(ctx.guild.id, user_id):
+        if cached := (await self.guild(ctx.guild.id)).get(user_id):
             return cached
 
         message = "That user is not registered." if user_id != ctx.author.id else "You are not registered."
         raise NotRegistered(message)
 
+    def _set_row(self, guild_id: int, user_id: int, row) -> None:
+        """Sets a cached user's columns from a copy of their row, unless a newer one was already applied.
+
+        Copies come both from guarded updates and from CacheListener events, in no particular order."""
+        key = (guild_id, user_id)
+        if (seen := self._row_versions.get(key)) is not None and seen[1] >= row['version']:
+            return
+        if user := self.from_cache(guild_id, user_id):
+            user['cash'] = row['cash']
+            user['vault'] = row['vault']
+            user['pet_name'] = row['pet_name']
+            user['level'] = row['level']
+            self._row_versions[key] = (time.monotonic(), row['version'])
+            self.rerank(guild_id, user_id)
+
+    async def _mutate(self, guild_id: int, user_id: int, name: str, *args, xp: int = 0, conn=None):
+        """Runs one of the guarded UPDATEs from :data:`utils.statements.STATEMENTS` and sets the cached user from
+        the row it returns. ``xp`` is added to the cached XP as well, since that is never read back.
+
+        Returns None, leaving the cache alone, when the guard stopped the update."""
+        await self.guild(guild_id)
+        row = await self.pool.run(name, *args, method='fetchrow', conn=conn)
+        if row is None:
+            return None
+        if xp and (user := self.from_cache(guild_id, user_id)):
+            user['xp'] += xp
+            self.rerank(guild_id, user_id)
+        self._set_row(guild_id, user_id, row)
+        return row
+
     async def edit_user(self, ctx: CustomContext, method: str, value: int, **kwargs) -> None:
         if method not in ('cash', 'vault', 'xp', 'level'):
             raise TypeError("Invalid method provided.")
-        conn = kwargs.pop('conn', self.pool)
+        conn = kwargs.pop('conn', None)
         user_id = kwargs.pop('user_id', ctx.author.id)
 
-        self.cache[ctx.guild.id][user_id][method] += value
-        query = f"UPDATE users SET {method} = {method} + $1 WHERE guild_id = $2 AND user_id = $3"
-        await conn.execute(query, value, ctx.guild.id, user_id)
+        xp = value if method == 'xp' else 0
+        row = await self._mutate(ctx.guild.id, user_id, f'add_{method}', value, ctx.guild.id, user_id, xp=xp, conn=conn)
+        if row is None:
+            raise InsufficientFunds("That's more money than you have.")
 
     async def edit_pet(self, ctx: CustomContext, name: str, **kwargs) -> None:  # TODO add valid values
-        conn = kwargs.pop('conn', self.pool)
+        conn = kwargs.pop('conn', None)
         user_id = kwargs.pop('user_id', ctx.author.id)
 
-        self.cache[ctx.guild.id][user_id]['pet_name'] = name
-        query = "UPDATE users SET pet_name = $1 WHERE guild_id = $2 AND user_id = $3"
-        await conn.execute(query, name, ctx.guild.id, user_id)
+        await self._mutate(ctx.guild.id, user_id, 'edit_pet', name, ctx.guild.id, user_id, conn=conn)
 
     async def withdraw(self, ctx: CustomContext, amount: int, **kwargs) -> None:
-        conn = kwargs.pop('conn', self.pool)
+        conn = kwargs.pop('conn', None)
 
-        self.cache[ctx.guild.id][ctx.author.id]['cash'] += amount
-        self.cache[ctx.guild.id][ctx.author.id]['vault'] -= amount
-
-        query = "UPDATE users SET cash = cash + $1, vault = vault - $1 WHERE guild_id = $2 AND user_id = $3"
-        await conn.execute(query, amount, ctx.guild.id, ctx.author.id)
+        row = await self._mutate(
+            ctx.guild.id, ctx.author.id, 'withdraw', amount, ctx.guild.id, ctx.author.id, conn=conn
+        )
+        if row is None:
+            raise InsufficientFunds("You don't have that much money in your vault.")
 
     async def deposit(self, ctx: CustomContext, amount: int, **kwargs) -> None:
-        conn = kwargs.pop('conn', self.pool)
+        conn = kwargs.pop('conn', None)
+
+        row = await self._mutate(
+            ctx.guild.id, ctx.author.id, 'deposit', amount, ctx.guild.id, ctx.author.id, conn=conn
+        )
+        if row is None:
+            raise InsufficientFunds("That's more money than you have.")
 
-        self.cache[ctx.guild.id][ctx.author.id]['cash'] -= amount
-        self.cache[ctx.guild.id][ctx.author.id]['vault'] += amount
+    async def level_up(self, ctx: CustomContext, level: int, cost: int) -> bool:
+        """Takes a user from ``level`` to the next one for ``cost`` XP. False if they weren't on ``level`` anymore."""
+        row = await self._mutate(
+            ctx.guild.id, ctx.author.id, 'level_up', cost, ctx.guild.id, ctx.author.id, level, xp=-cost
+        )
+        return row is not None
 
-        query = "UPDATE users SET cash = cash - $1, vault = vault + $1 WHERE guild_id = $2 AND user_id = $3"
-        await conn.execute(query, amount, ctx.guild.id, ctx.author.id)
+    async def flush_xp(self, batch: dict, **kwargs) -> None:
+        """Adds XP that is already in the cache to the database. ``batch`` maps (guild_id, user_id) to XP."""
+        conn = kwargs.pop('conn', self.pool)
+        guild_ids, user_ids = zip(*batch)
+        query = (
+            """
+            UPDATE users SET xp = users.xp + batch.xp
+            FROM unnest($1::BIGINT[], $2::BIGINT[], $3::BIGINT[]) AS batch (guild_id, user_id, xp)
+            WHERE users.guild_id = batch.guild_id AND users.user_id = batch.user_id
+            """
+        )
+        await conn.execute(query, guild_ids, user_ids, tuple(batch.values()))
 
     async def unregister_user(self, ctx: CustomContext) -> bool:
         try:
-            del self.cache[ctx.guild.id][ctx.author.id]
+            del (await self.guild(ctx.guild.id))[ctx.author.id]
         except KeyError:
             return False
         else:
-            await self.pool.execute(
-                "DELETE FROM users WHERE guild_id = $1 AND user_id = $2",
-                ctx.guild.id, ctx.author.id
+            self.users -= 1
+            self.rankings[ctx.guild.id].remove(ctx.author.id)
+            self._row_versions.pop((ctx.guild.id, ctx.author.id), None)
+            query = (
+                """
+                WITH deleted AS (
+                    DELETE FROM users WHERE guild_id = $1 AND user_id = $2 RETURNING guild_id
+                )
+                UPDATE guilds SET user_count = user_count - (SELECT COUNT(*) FROM deleted)
+                WHERE guild_id = $1
+                """
             )
+            await self.pool.execute(query, ctx.guild.id, ctx.author.id)
             return True
 
     async def register_user(self, ctx: CustomContext) -> bool:
-        if self.cache.get(ctx.guild.id, {}).get(ctx.author.id):
+        users = await self.guild(ctx.guild.id)
+        if users.get(ctx.author.id):
             return False
-        data = dict(await self.pool.fetchrow("INSERT INTO users VALUES ($1, $2) RETURNING *", ctx.guild.id, ctx.author.id))
-        self.cache[data.pop('guild_id')][data.pop('user_id')] = data
+        row = await self.pool.run('register_user', ctx.guild.id, ctx.author.id, method='fetchrow')
+        guild_id, user_id = row['guild_id'], row['user_id']
+        users[user_id] = UserRecord.from_row(row)
+        self.users += 1
+        self.rerank(guild_id, user_id)
         return True
 
 
@@ -97,6 +350,11 @@ class Manager(asyncpg.Pool):
     def __init__(self, bot: Mao, *args, **kwargs):
         self.bot = bot
         self.cache = {}
+        self.cooldowns = CooldownStore()
+        query_stats.slow_seconds = self.bot.settings.get('database', {}).get('slow_query_ms', 100) / 1000
+        self.cooldown_persist_seconds = self.bot.settings.get('cooldowns', {}).get('persist_seconds', 60)
+        self._dirty_cooldowns = set()
+        self.restored_cooldowns = None
         self.bot.loop.create_task(self.prepare_cache())
         self.economy = EconomyNode(self, self.bot)
         super().__init__(*args, **kwargs)
@@ -104,69 +362,111 @@ class Manager(asyncpg.Pool):
     async def prepare_cache(self):
         await self.bot._prepped.wait()
         self.cache = await self.guild_cache()
-        self.cache['cooldowns'] = {
-            'guild': {g.id: defaultdict(dict) for g in self.bot.guilds},
-            'user': defaultdict(dict)
-        }
-        cooldowns = await self.fetch('SELECT * FROM cooldowns')
-        for cooldown in cooldowns:
-            if g_id := cooldown['guild_id']:
-                self.cache['cooldowns']['guild'][g_id][cooldown['user_id']][cooldown['command']] = cooldown['expires']
-            else:
-                self.cache['cooldowns']['user'][cooldown['user_id']][cooldown['command']] = cooldown['expires']
+        # short cooldowns never reach the table, so a snapshot is the only way they survive a restart
+        if self.restored_cooldowns:
+            self.cooldowns.load(self.restored_cooldowns)
+        query = (
+            f"""
+            SELECT guild_id, user_id, command, expires FROM cooldowns
+            WHERE expires > $1 AND (guild_id IS NULL OR {shard_filter('guild_id', 2)})
+            """
+        )
+        self.cooldowns.load(await self.fetch(query, time.time(), *self.bot.shard_params))
+        self.restored_cooldowns = None
+
+    def cooldown_entries(self) -> list:
+        """Every running cooldown as (guild_id, user_id, command, expires), guild_id being None for user cooldowns."""
+        return self.cooldowns.entries()
+
+    def restore_cooldowns(self, cooldowns: list) -> int:
+        """Queues snapshotted cooldowns for the next cache load, where the table wins for anything it also has."""
+        now = time.time()
+        self.restored_cooldowns = [entry for entry in cooldowns if entry[-1] > now]
+        return len(self.restored_cooldowns)
 
     async def guild_cache(self):
         tables = {
             'guild_config': {}
         }
-        cache = {guild.id: tables for guild in self.bot.guilds}
+        cache = {guild.id: {table: {} for table in tables} for guild in self.bot.guilds}
 
         async with self.acquire() as conn:
             for table in tables:
-                data = await conn.fetch(f"SELECT * FROM {table}")
+                data = await conn.fetch(
+                    f"SELECT * FROM {table} WHERE {shard_filter('guild_id', 1)}", *self.bot.shard_params
+                )
                 for item in data:
                     item = dict(item)
                     if table == 'guild_config':
-                        cache[item.pop('guild_id')]['guild_config'] = item
+                        cache.setdefault(item.pop('guild_id'), {})['guild_config'] = item
         return cache
 
-    async def set_cooldown(self, ctx: CustomContext, epoch: float, guild: bool):
-        command = ctx.command.qualified_name
-        _type = 'guild' if guild else 'user'
+    async def run(self, name: str, *args, method: str = 'execute', conn=None):
+        """Runs a prepared statement from :mod:`utils.statements` by name, see ``InstrumentedConnection.run``."""
+        if conn is not None:
+            return await conn.run(name, *args, method=method)
+        async with self.acquire() as conn:
+            return await conn.run(name, *args, method=method)
 
-        if _type == 'guild':
-            self.cache['cooldowns']["guild"][ctx.guild.id][ctx.author.id][command] = epoch
-            query = (
-                """
-                INSERT INTO
-                    cooldowns
-                VALUES
-                    ($1, $2, $3, $4)
-                ON CONFLICT
-                    DO UPDATE
-                        SET
-                            expires = $4
-                """
-            )
-            values = (ctx.guild.id, ctx.author.id, command, epoch)
-            await self.execute(query, *values)
+    async def _acquire(self, timeout):
+        # everything, pool methods included, gets its connection through here
+        started = time.perf_counter()
+        try:
+            return await super()._acquire(timeout)
+        finally:
+            elapsed = time.perf_counter() - started
+            query_stats.record_acquire(elapsed)
+            metrics.POOL_ACQUIRE_WAIT.observe(elapsed)
 
-        elif _type == 'user':
-            self.cache['cooldowns']["user"][ctx.author.id][command] = epoch
-            query = (
-                """
-                INSERT INTO
-                    cooldowns (user_id, command, expires)
-                VALUES
-                    ($1, $2, $3)
-                ON CONFLICT
-                    DO UPDATE
-                        SET
-                            expires = $3
-                """
+    def connection_stats(self) -> tuple:
+        """(open connections, connections acquired right now)."""
+        holders = self._holders
+        connected = sum(1 for holder in holders if holder._con is not None)
+        return connected, len(holders) - self._queue.qsize()
+
+    def level_curve(self, guild_id: int) -> LevelCurve:
+        config = self.cache.get(guild_id, {}).get('guild_config', {})
+        return get_curve(config.get('level_base', 1000), config.get('level_growth', 1.0))
+
+    def set_cooldown(self, ctx: CustomContext, epoch: float, guild: bool):
+        key = self.cooldowns.key(ctx.guild.id if guild else None, ctx.author.id, ctx.command.qualified_name)
+        self.cooldowns.set(key, epoch)
+        # see flush_cooldowns, anything shorter isn't worth a write
+        if epoch - time.time() >= self.cooldown_persist_seconds:
+            self._dirty_cooldowns.add(key)
+
+    async def flush_cooldowns(self) -> int:
+        """Writes every long cooldown set since the last flush in one statement."""
+        if not self._dirty_cooldowns:
+            return 0
+        dirty, self._dirty_cooldowns = self._dirty_cooldowns, set()
+        rows = [(*key, expires) for key in dirty if (expires := self.cooldowns.get(key)) is not None]
+        if not rows:
+            return 0
+
+        query = (
+            """
+            WITH batch AS (
+                SELECT * FROM unnest($1::BIGINT[], $2::BIGINT[], $3::TEXT[], $4::DOUBLE PRECISION[])
+                    AS batch (guild_id, user_id, command, expires)
+            ), guild_cooldowns AS (
+                INSERT INTO cooldowns (guild_id, user_id, command, expires)
+                SELECT batch.* FROM batch JOIN guilds USING (guild_id)
+                ON CONFLICT (guild_id, user_id, command) WHERE guild_id IS NOT NULL
+                    DO UPDATE SET expires = EXCLUDED.expires
             )
-            values = (ctx.author.id, command, epoch)
-            await self.execute(query, *values)
+            INSERT INTO cooldowns (user_id, command, expires)
+            SELECT user_id, command, expires FROM batch WHERE guild_id IS NULL
+            ON CONFLICT (user_id, command) WHERE guild_id IS NULL
+                DO UPDATE SET expires = EXCLUDED.expires
+            """
+        )
+        try:
+            await self.execute(query, *zip(*rows))
+        except Exception:
+            self._dirty_cooldowns |= dirty
+            raise
+        return len(rows)
 
 
 def create_pool(
@@ -177,9 +477,9 @@ def create_pool(
         max_queries=50000,
         max_inactive_connection_lifetime=300.0,
         setup=None,
-        init=None,
+        init=prepare_statements,
         loop=None,
-        connection_class=asyncpg.connection.Connection,
+        connection_class=InstrumentedConnection,
         record_class=asyncpg.protocol.Record,
         **connect_kwargs
 ):
@@ -2,4 +2,8 @@ from discord.ext import commands
 
 
 class NotRegistered(commands.CommandError):
-    pass
\ No newline at end of file
+    pass
+
+
+class InsufficientFunds(commands.BadArgument):
+    pass
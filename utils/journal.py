@@ -0,0 +1,97 @@
+import logging
+import os
+import struct
+import threading
+from collections import defaultdict
+
+log = logging.getLogger("XPJournal")
+
+RECORD = struct.Struct("<qqq")  # guild_id, user_id, xp
+
+
+class XPJournal:
+    """Append-only journal of XP deltas that haven't been written to the database yet.
+
+    Deltas are appended to the open segment as they happen and fsynced in batches by :meth:`sync`.
+    :meth:`rotate` closes the open segment when a batch is taken for flushing, and :meth:`commit`
+    deletes every closed segment once that flush succeeds. Segments left over from a previous run are
+    only read by :meth:`replay` and removed by :meth:`finish_replay`. Replay is at-least-once: a crash
+    between a database write and the matching delete applies that batch twice."""
+
+    def __init__(self, path: str = 'xp_journal'):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        self._leftover = self._segments()
+        self._closed = []
+        self._seq = int(os.path.basename(self._leftover[-1]).split('.')[0]) + 1 if self._leftover else 0
+        self._dirty = False
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _segments(self) -> list:
+        names = sorted((n for n in os.listdir(self.path) if n.endswith('.log')), key=lambda n: int(n.split('.')[0]))
+        return [os.path.join(self.path, name) for name in names]
+
+    def _open(self):
+        self._file = open(os.path.join(self.path, f"{self._seq}.log"), 'ab')
+        self._seq += 1
+
+    def append(self, guild_id: int, user_id: int, xp: int) -> None:
+        if self._file is None:
+            self._open()
+        self._file.write(RECORD.pack(guild_id, user_id, xp))
+        self._dirty = True
+
+    def sync(self) -> None:
+        """Flushes and fsyncs the open segment. This blocks, so run it in an executor."""
+        with self._lock:
+            if self._file is None or not self._dirty:
+                return
+            self._dirty = False
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def rotate(self) -> None:
+        """Closes the open segment, marking everything appended so far as part of the flush in progress."""
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._closed.append(self._file.name)
+            self._file = None
+            self._dirty = False
+
+    @staticmethod
+    def _remove(segments: list) -> None:
+        for segment in segments:
+            try:
+                os.remove(segment)
+            except FileNotFoundError:
+                pass
+        segments.clear()
+
+    def commit(self) -> None:
+        """Deletes every closed segment. Call this once their XP is in the database."""
+        self._remove(self._closed)
+
+    def replay(self) -> dict:
+        """Sums the deltas in every segment left over from a previous run, keyed by (guild_id, user_id)."""
+        totals = defaultdict(int)
+        for segment in self._leftover:
+            with open(segment, 'rb') as f:
+                data = f.read()
+            # a crash can leave half a record at the end, which was never acknowledged anyway
+            usable = len(data) - len(data) % RECORD.size
+            for guild_id, user_id, xp in RECORD.iter_unpack(data[:usable]):
+                totals[(guild_id, user_id)] += xp
+        return dict(totals)
+
+    def finish_replay(self) -> None:
+        """Deletes the segments read by :meth:`replay`. Call this once their XP is in the database."""
+        self._remove(self._leftover)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,52 @@
+from bisect import bisect_right
+from functools import lru_cache
+
+
+class LevelCurve:
+    """XP needed per level, with the cumulative totals precomputed.
+
+    Going from ``level`` to ``level + 1`` costs ``base * level ** growth`` XP, and users keep the
+    leftover XP after levelling up. The cumulative table grows on demand, so converting between
+    (level, xp) and total XP is a list index one way and a bisect the other."""
+
+    def __init__(self, base: int = 1000, growth: float = 1.0, precompute: int = 1000):
+        self.base = base
+        self.growth = growth
+        # _totals[n] is the total XP spent to get from level 1 to level n + 1
+        self._totals = [0]
+        self._extend(precompute)
+
+    def _extend(self, level: int) -> None:
+        totals = self._totals
+        while len(totals) < level:
+            totals.append(totals[-1] + self.threshold(len(totals)))
+
+    def threshold(self, level: int) -> int:
+        """XP needed to go from ``level`` to the next one."""
+        return round(self.base * level ** self.growth)
+
+    def total_xp(self, level: int, xp: int) -> int:
+        if level > len(self._totals):
+            self._extend(level)
+        return self._totals[level - 1] + xp
+
+    def total_xp_many(self, users) -> list:
+        """Total XP of every (level, xp) pair, e.g. a whole leaderboard page."""
+        users = list(users)
+        if users:
+            self._extend(max(level for level, _ in users))
+        totals = self._totals
+        return [totals[level - 1] + xp for level, xp in users]
+
+    def from_total(self, total_xp: int) -> tuple:
+        """The (level, xp) that ``total_xp`` adds up to."""
+        while self._totals[-1] <= total_xp:
+            self._extend(len(self._totals) * 2)
+        level = bisect_right(self._totals, total_xp)
+        return level, total_xp - self._totals[level - 1]
+
+
+@lru_cache(maxsize=64)
+def get_curve(base: int = 1000, growth: float = 1.0) -> LevelCurve:
+    """Shared curve for a set of settings, so guilds with the same settings share one table."""
+    return LevelCurve(base, growth)
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import math
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger("Metrics")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def clear(self) -> None:
+        self._values.clear()
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, _labels(self.labels, key), value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {_value(value)}" for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # one count per bucket plus +Inf, then the sum
+            state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def samples(self):
+        for key, state in self._values.items():
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf,), state):
+                total += count
+                yield f"{self.name}_bucket", _labels(self.labels, key, f'le="{_value(bound)}"'), total
+            yield f"{self.name}_sum", _labels(self.labels, key), state[-1]
+            yield f"{self.name}_count", _labels(self.labels, key), total
+
+
+class Registry:
+    """Metrics in the Prometheus text format. Collectors run before each render, for gauges that are read off
+    something else (pool sizes, queue depths) rather than kept up to date as they change."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _add(self, metric: Metric) -> Metric:
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        return self._add(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: tuple = ()) -> Gauge:
+        return self._add(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, labels, buckets))
+
+    def collector(self, func):
+        self._collectors.append(func)
+        return func
+
+    def render(self) -> str:
+        for func in self._collectors:
+            try:
+                func()
+            except Exception:
+                logger.exception(f"Metrics collector {func.__qualname__} failed")
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+registry = Registry()
+
+COMMAND_LATENCY = registry.histogram(
+    'mao_command_duration_seconds', 'Time from invoking a command to it finishing.', ('command', 'status')
+)
+LOOP_LAG = registry.histogram(
+    'mao_event_loop_lag_seconds', 'How late the event loop woke up a sleeping task.',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+)
+
+POOL_CONNECTIONS = registry.gauge('mao_db_pool_connections', 'Connections open in the asyncpg pool.')
+POOL_IN_USE = registry.gauge('mao_db_pool_in_use', 'Connections currently acquired from the asyncpg pool.')
+POOL_ACQUIRE_WAIT = registry.histogram(
+    'mao_db_pool_acquire_seconds', 'Time spent waiting for a pool connection.',
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+)
+GATEWAY_LATENCY = registry.gauge('mao_gateway_latency_seconds', 'Heartbeat latency of each shard.', ('shard',))
+XP_BATCH_USERS = registry.histogram(
+    'mao_xp_batch_users', 'Users written by each XP flush.', buckets=(1, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+)
+XP_BATCH_MESSAGES = registry.counter('mao_xp_messages_total', 'Messages whose XP has been flushed.')
+XP_FLUSH = registry.histogram('mao_xp_flush_seconds', 'Time taken by each XP flush.')
+XP_FLUSH_FAILURES = registry.counter('mao_xp_flush_failures_total', 'XP flushes that failed and were retried.')
+RENDER_QUEUE = registry.gauge('mao_render_queue_depth', 'Rank cards waiting for or being rendered.')
+ECONOMY_USERS = registry.gauge('mao_economy_cached_users', 'Users held in the economy cache.')
+
+
+async def measure_loop_lag(bot, interval: float = 0.5) -> None:
+    while not bot.is_closed():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(time.perf_counter() - started - interval, 0))
+
+
+async def serve(host: str, port: int, shutdown: asyncio.Event) -> None:
+    """Serves :data:`registry` on ``/metrics`` until ``shutdown`` is set."""
+    from hypercorn.asyncio import serve as hypercorn_serve
+    from hypercorn.config import Config
+    from quart import Quart, Response
+
+    app = Quart("Mao")
+
+    @app.route('/metrics')
+    async def metrics():
+        return Response(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    config = Config()
+    config.bind = [f"{host}:{port}"]
+    config.accesslog = None
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    # without a shutdown trigger hypercorn installs its own signal handlers over discord.py's
+    await hypercorn_serve(app, config, shutdown_trigger=shutdown.wait)
@@ -0,0 +1,32 @@
+import hashlib
+import logging
+
+log = logging.getLogger("Migrations")
+
+# arbitrary, just has to be the same for every process sharing the database
+MIGRATION_LOCK = 0x6D616F
+
+
+async def migrate(conn, path: str) -> bool:
+    """Runs schema.sql only when it changed since the last run.
+
+    The schema is written to be re-runnable, so its hash is the version. Returns whether it ran."""
+    with open(path) as f:
+        schema = f.read()
+    version = hashlib.sha256(schema.encode('utf-8')).hexdigest()
+
+    if await conn.fetchval("SELECT to_regclass('schema_version') IS NOT NULL"):
+        if await conn.fetchval("SELECT version FROM schema_version") == version:
+            return False
+
+    async with conn.transaction():
+        # another process might be migrating at the same time
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK)
+        await conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version TEXT NOT NULL)")
+        if await conn.fetchval("SELECT version FROM schema_version") == version:
+            return False
+        await conn.execute(schema)
+        await conn.execute("DELETE FROM schema_version")
+        await conn.execute("INSERT INTO schema_version VALUES ($1)", version)
+    log.info(f"Applied schema version {version[:12]}")
+    return True
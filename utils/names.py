@@ -0,0 +1,69 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import discord
+
+
+class NameResolver:
+    """Turns user ids into display names for leaderboards.
+
+    Guild members and cached users are used first. Anyone else is fetched from the API,
+    a few at a time, and the result is remembered for ``ttl`` seconds, including users
+    that no longer exist."""
+
+    def __init__(self, bot, ttl: float = 600, concurrency: int = 5, max_size: int = 10000):
+        self.bot = bot
+        self.ttl = ttl
+        self.max_size = max_size
+        self._cache: OrderedDict = OrderedDict()
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def _cached(self, user_id: int):
+        try:
+            expires, name = self._cache[user_id]
+        except KeyError:
+            return False, None
+        if expires < time.monotonic():
+            del self._cache[user_id]
+            return False, None
+        return True, name
+
+    def _store(self, user_id: int, name):
+        self._cache[user_id] = (time.monotonic() + self.ttl, name)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    async def _fetch(self, user_id: int):
+        async with self._semaphore:
+            try:
+                user = await self.bot.fetch_user(user_id)
+            except discord.NotFound:
+                name = None
+            except discord.HTTPException:
+                return None  # might work next time, so don't remember it
+            else:
+                name = str(user)
+        self._store(user_id, name)
+        return name
+
+    async def resolve(self, guild: discord.Guild, user_ids) -> dict:
+        """Maps every id to a name, or None for users that couldn't be found."""
+        names = {}
+        missing = []
+        for user_id in user_ids:
+            user = (guild and guild.get_member(user_id)) or self.bot.get_user(user_id)
+            if user:
+                names[user_id] = str(user)
+                continue
+            found, name = self._cached(user_id)
+            if found:
+                names[user_id] = name
+            else:
+                missing.append(user_id)
+
+        if missing:
+            fetched = await asyncio.gather(*(self._fetch(user_id) for user_id in missing))
+            names.update(zip(missing, fetched))
+        return names
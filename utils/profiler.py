@@ -0,0 +1,49 @@
+from collections import Counter, deque
+
+PHASES = ('check', 'convert', 'callback', 'reply', 'total')
+
+
+def percentile(ordered: list, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class CommandProfiler:
+    """Rolling latency samples for every command, split into the phases of an invoke.
+
+    Each command and phase keeps only its last ``window`` samples, so memory stays flat however
+    long the bot has been up and the percentiles follow recent behaviour instead of all-time."""
+
+    def __init__(self, window: int = 512):
+        self.window = window
+        self.calls = Counter()
+        self._samples = {}
+
+    def record(self, command: str, timings: dict) -> None:
+        samples = self._samples.get(command)
+        if samples is None:
+            samples = self._samples[command] = {phase: deque(maxlen=self.window) for phase in PHASES}
+        for phase in PHASES:
+            samples[phase].append(timings.get(phase, 0.0))
+        self.calls[command] += 1
+
+    def stats(self, command: str) -> dict:
+        """p50, p95 and p99 in milliseconds for each phase of a command."""
+        ret = {}
+        for phase, samples in self._samples[command].items():
+            ordered = sorted(samples)
+            ret[phase] = {
+                name: percentile(ordered, fraction) * 1000
+                for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+            }
+        return ret
+
+    def slowest(self, limit: int = 10, phase: str = 'total', by: str = 'p95') -> list:
+        """(command, calls, stats) for the commands with the worst ``by`` percentile of ``phase``."""
+        ranked = [(command, self.calls[command], self.stats(command)) for command in self._samples]
+        ranked.sort(key=lambda item: item[2][phase][by], reverse=True)
+        return ranked[:limit]
+
+    def reset(self) -> None:
+        self.calls.clear()
+        self._samples.clear()
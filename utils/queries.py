@@ -0,0 +1,176 @@
+import contextvars
+import logging
+import re
+import time
+
+import asyncpg
+from asyncpg.prepared_stmt import PreparedStatement
+
+from utils.statements import STATEMENTS
+
+logger = logging.getLogger("Queries")
+
+# qualified name of the command being invoked, set by Mao.invoke so slow queries can say who ran them
+current_command = contextvars.ContextVar('current_command', default=None)
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def template(query: str) -> str:
+    return _WHITESPACE.sub(' ', query).strip()
+
+
+def row_count(status: str) -> int:
+    """Rows affected according to a command status like ``UPDATE 5`` or ``INSERT 0 1``."""
+    count = status.rpartition(' ')[2] if status else ''
+    return int(count) if count.isdigit() else 0
+
+
+class TemplateStats:
+    __slots__ = ('calls', 'total', 'max', 'rows')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+
+
+class QueryStats:
+    """Per-template timings of every query, plus how long callers waited for a pool connection.
+
+    Only the first ``max_templates`` distinct queries get their own entry, so ad-hoc queries from
+    the owner sql commands can't grow this forever; the rest are lumped together."""
+
+    OTHER = '<other>'
+
+    def __init__(self, slow_seconds: float = 0.1, max_templates: int = 500):
+        self.slow_seconds = slow_seconds
+        self.max_templates = max_templates
+        self.templates = {}
+        self._keys = {}  # raw query text to its template, so the regex only runs once per query
+        self.acquires = 0
+        self.acquire_wait = 0.0
+        self.acquire_max = 0.0
+
+    def record(self, query: str, elapsed: float, rows: int) -> None:
+        key = self._keys.get(query)
+        if key is None:
+            key = template(query)
+            if len(self._keys) < self.max_templates * 2:
+                self._keys[query] = key
+        stats = self.templates.get(key)
+        if stats is None:
+            if len(self.templates) >= self.max_templates:
+                key = self.OTHER
+            stats = self.templates.setdefault(key, TemplateStats())
+        stats.calls += 1
+        stats.total += elapsed
+        stats.max = max(stats.max, elapsed)
+        stats.rows += rows
+
+        if elapsed >= self.slow_seconds:
+            logger.warning(
+                f"Slow query ({elapsed * 1000:.1f}ms, {rows} rows, command {current_command.get() or 'none'}): "
+                f"{key[:500]}"
+            )
+
+    def record_acquire(self, elapsed: float) -> None:
+        self.acquires += 1
+        self.acquire_wait += elapsed
+        self.acquire_max = max(self.acquire_max, elapsed)
+
+    def top(self, limit: int = 10) -> list:
+        """(template, stats) with the most total time first."""
+        return sorted(self.templates.items(), key=lambda item: item[1].total, reverse=True)[:limit]
+
+    def reset(self) -> None:
+        self.templates.clear()
+        self.acquires = 0
+        self.acquire_wait = self.acquire_max = 0.0
+
+
+stats = QueryStats()
+
+
+class InstrumentedConnection(asyncpg.connection.Connection):
+    """Connection class for :class:`utils.db.Manager`. The pool's own query methods run through these too,
+    so queries are counted once whether they go through the pool or an acquired connection."""
+
+    _resetting = False
+    _prepared = None
+
+    async def prepare_statements(self) -> None:
+        self._prepared = {}
+        for name, query in STATEMENTS.items():
+            try:
+                self._prepared[name] = await self.prepare(query)
+            except asyncpg.PostgresError:
+                pass  # the tables may not exist before the first migration, run() prepares it later
+
+    async def run(self, name: str, *args, method: str = 'execute'):
+        """Runs a statement from :data:`utils.statements.STATEMENTS`. ``method`` is execute, fetch, fetchrow or
+        fetchval, execute returning the status like :meth:`execute` does."""
+        if self._prepared is None:
+            self._prepared = {}
+        statement = self._prepared.get(name)
+        if statement is None:
+            statement = self._prepared[name] = await self.prepare(STATEMENTS[name])
+        elif statement._con_release_ctr != self._pool_release_ctr:
+            # the pool retires statement objects on every release, but the server still has the statement
+            statement = self._prepared[name] = PreparedStatement(self, STATEMENTS[name], statement._state)
+
+        started = time.perf_counter()
+        call = 'fetch' if method == 'execute' else method
+        try:
+            result = await getattr(statement, call)(*args)
+        except asyncpg.InvalidCachedStatementError:
+            # a migration changed a table under it, which can only be retried outside a transaction
+            if self.is_in_transaction():
+                raise
+            statement = self._prepared[name] = await self.prepare(STATEMENTS[name])
+            result = await getattr(statement, call)(*args)
+        status = statement.get_statusmsg()
+        stats.record(STATEMENTS[name], time.perf_counter() - started, row_count(status))
+        return status if method == 'execute' else result
+
+    async def reset(self, **kwargs):
+        # the pool runs this on every release, it isn't anyone's query
+        self._resetting = True
+        try:
+            return await super().reset(**kwargs)
+        finally:
+            self._resetting = False
+
+    async def execute(self, query: str, *args, **kwargs) -> str:
+        if self._resetting:
+            return await super().execute(query, *args, **kwargs)
+        started = time.perf_counter()
+        status = await super().execute(query, *args, **kwargs)
+        stats.record(query, time.perf_counter() - started, row_count(status))
+        return status
+
+    async def executemany(self, command: str, args, **kwargs):
+        args = list(args)
+        started = time.perf_counter()
+        ret = await super().executemany(command, args, **kwargs)
+        stats.record(command, time.perf_counter() - started, len(args))
+        return ret
+
+    async def fetch(self, query: str, *args, **kwargs) -> list:
+        started = time.perf_counter()
+        rows = await super().fetch(query, *args, **kwargs)
+        stats.record(query, time.perf_counter() - started, len(rows))
+        return rows
+
+    async def fetchrow(self, query: str, *args, **kwargs):
+        started = time.perf_counter()
+        row = await super().fetchrow(query, *args, **kwargs)
+        stats.record(query, time.perf_counter() - started, row is not None)
+        return row
+
+    async def fetchval(self, query: str, *args, **kwargs):
+        started = time.perf_counter()
+        value = await super().fetchval(query, *args, **kwargs)
+        stats.record(query, time.perf_counter() - started, 1)
+        return value
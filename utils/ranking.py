@@ -0,0 +1,207 @@
+from bisect import bisect_left, insort
+
+
+class SortedKeys:
+    """Sorted list split into chunks, with a Fenwick tree over the chunk lengths.
+
+    Inserts and deletes only shift one chunk, and both position lookups (:meth:`index`)
+    and positional access (:meth:`__getitem__`) walk the tree, so everything is O(log n)
+    apart from the occasional chunk split or removal."""
+
+    LOAD = 512
+
+    def __init__(self):
+        self._lists = []
+        self._maxes = []
+        self._tree = []
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    @classmethod
+    def from_sorted(cls, keys: list) -> "SortedKeys":
+        """Builds the list straight from keys that are already sorted, skipping the per-key inserts."""
+        self = cls()
+        self._lists = [keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)]
+        self._maxes = [chunk[-1] for chunk in self._lists]
+        self._len = len(keys)
+        self._rebuild()
+        return self
+
+    def _rebuild(self):
+        tree = [len(chunk) for chunk in self._lists]
+        for i in range(len(tree)):
+            parent = i | (i + 1)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _bump(self, pos: int, delta: int):
+        tree = self._tree
+        while pos < len(tree):
+            tree[pos] += delta
+            pos |= pos + 1
+
+    def _prefix(self, pos: int) -> int:
+        """Number of keys in the chunks before ``pos``."""
+        total = 0
+        pos -= 1
+        while pos >= 0:
+            total += self._tree[pos]
+            pos = (pos & (pos + 1)) - 1
+        return total
+
+    def _locate(self, idx: int) -> tuple:
+        """Chunk and offset of the key at position ``idx``."""
+        pos = 0
+        step = 1 << (len(self._tree).bit_length())
+        while step:
+            nxt = pos + step - 1
+            if nxt < len(self._tree) and self._tree[nxt] <= idx:
+                idx -= self._tree[nxt]
+                pos += step
+            step >>= 1
+        return pos, idx
+
+    def add(self, key):
+        if not self._maxes:
+            self._lists.append([key])
+            self._maxes.append(key)
+            self._len = 1
+            self._rebuild()
+            return
+
+        pos = bisect_left(self._maxes, key)
+        if pos == len(self._maxes):
+            pos -= 1
+            self._lists[pos].append(key)
+            self._maxes[pos] = key
+        else:
+            insort(self._lists[pos], key)
+        self._len += 1
+
+        chunk = self._lists[pos]
+        if len(chunk) > self.LOAD * 2:
+            self._lists.insert(pos + 1, chunk[self.LOAD:])
+            del chunk[self.LOAD:]
+            self._maxes.insert(pos, chunk[-1])
+            self._rebuild()
+        else:
+            self._bump(pos, 1)
+
+    def remove(self, key):
+        pos = bisect_left(self._maxes, key)
+        if pos == len(self._maxes):
+            raise ValueError(f"{key!r} is not in the list")
+        chunk = self._lists[pos]
+        idx = bisect_left(chunk, key)
+        if idx == len(chunk) or chunk[idx] != key:
+            raise ValueError(f"{key!r} is not in the list")
+        del chunk[idx]
+        self._len -= 1
+
+        if not chunk:
+            del self._lists[pos]
+            del self._maxes[pos]
+            self._rebuild()
+        else:
+            self._maxes[pos] = chunk[-1]
+            self._bump(pos, -1)
+
+    def index(self, key) -> int:
+        """Number of keys that sort before ``key``."""
+        pos = bisect_left(self._maxes, key)
+        if pos == len(self._maxes):
+            return self._len
+        return self._prefix(pos) + bisect_left(self._lists[pos], key)
+
+    def __getitem__(self, idx: int):
+        if idx < 0:
+            idx += self._len
+        if not 0 <= idx < self._len:
+            raise IndexError("index out of range")
+        pos, offset = self._locate(idx)
+        return self._lists[pos][offset]
+
+    def slice(self, start: int, stop: int) -> list:
+        start, stop = max(start, 0), min(stop, self._len)
+        if start >= stop:
+            return []
+        pos, offset = self._locate(start)
+        ret = []
+        while len(ret) < stop - start:
+            ret.extend(self._lists[pos][offset:offset + stop - start - len(ret)])
+            pos, offset = pos + 1, 0
+        return ret
+
+    def __iter__(self):
+        for chunk in self._lists:
+            yield from chunk
+
+
+class GuildRanking:
+    """Every registered user of one guild, kept sorted by each leaderboard category.
+
+    Keys sort ascending, so scores are negated. Ties go to the higher user id, matching the
+    ``user_id DESC`` tiebreak of the SQL leaderboard."""
+
+    CATEGORIES = ('total', 'cash', 'vault', 'xp')
+
+    def __init__(self):
+        self._sorted = {category: SortedKeys() for category in self.CATEGORIES}
+        self._keys = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, user_id):
+        return user_id in self._keys
+
+    @classmethod
+    def build(cls, users: dict) -> "GuildRanking":
+        """Ranks a whole guild at once, sorting each category a single time."""
+        self = cls()
+        self._keys = {user_id: self.make_keys(user_id, data) for user_id, data in users.items()}
+        for num, category in enumerate(self.CATEGORIES):
+            self._sorted[category] = SortedKeys.from_sorted(sorted(keys[num] for keys in self._keys.values()))
+        return self
+
+    @staticmethod
+    def make_keys(user_id: int, data: dict) -> tuple:
+        return (
+            (-(data['cash'] + data['vault']), -user_id),
+            (-data['cash'], -user_id),
+            (-data['vault'], -user_id),
+            (-data['level'], -data['xp'], -user_id),
+        )
+
+    def update(self, user_id: int, data: dict) -> None:
+        new = self.make_keys(user_id, data)
+        old = self._keys.get(user_id)
+        for num, category in enumerate(self.CATEGORIES):
+            if old is not None:
+                if old[num] == new[num]:
+                    continue
+                self._sorted[category].remove(old[num])
+            self._sorted[category].add(new[num])
+        self._keys[user_id] = new
+
+    def remove(self, user_id: int) -> None:
+        old = self._keys.pop(user_id, None)
+        if old is None:
+            return
+        for num, category in enumerate(self.CATEGORIES):
+            self._sorted[category].remove(old[num])
+
+    def rank(self, category: str, user_id: int):
+        """1-based position of a user in a category, or None if they aren't registered."""
+        keys = self._keys.get(user_id)
+        if keys is None:
+            return None
+        return self._sorted[category].index(keys[self.CATEGORIES.index(category)]) + 1
+
+    def page(self, category: str, page: int, per_page: int = 10) -> list:
+        """User ids on a 1-based page of a category."""
+        start = (page - 1) * per_page
+        return [-key[-1] for key in self._sorted[category].slice(start, start + per_page)]
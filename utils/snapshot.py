@@ -0,0 +1,149 @@
+import mmap
+import os
+import struct
+import sys
+
+from utils.records import UserRecord
+
+MAGIC = b'MAOSNAP1'
+COUNT = struct.Struct('<I')
+STRING = struct.Struct('<H')
+GUILD_FLAGS = struct.Struct('<qB')  # guild_id, NON_LEVELING | WELCOMING
+COOLDOWN = struct.Struct('<qqId')  # guild_id (0 for user cooldowns), user_id, command, expires
+GUILD = struct.Struct('<qI')  # guild_id, user count
+USER = struct.Struct('<qqqqqi')  # user_id, cash, vault, xp, level, pet_name (-1 for NULL)
+
+NON_LEVELING = 1
+WELCOMING = 2
+
+
+class Snapshot:
+    """Caches written by :func:`write_snapshot` on shutdown, to be checked against the database on startup.
+
+    The file is a string table followed by fixed-width records for guild flags, cooldowns and
+    each guild's users, so it is read straight out of a memory map."""
+
+    def __init__(self, economy: dict, cooldowns: list, non_leveling: set, welcoming: set):
+        self.economy = economy
+        self.cooldowns = cooldowns
+        self.non_leveling = non_leveling
+        self.welcoming = welcoming
+
+
+def economy_checksum(users: dict) -> tuple:
+    """Same columns as the aggregate the bot compares it with on startup."""
+    return (
+        len(users),
+        sum(users),
+        sum(user.cash for user in users.values()),
+        sum(user.vault for user in users.values()),
+        sum(user.xp for user in users.values()),
+        sum(user.level for user in users.values()),
+        sum(len(user.pet_name or '') for user in users.values()),
+    )
+
+
+def write_snapshot(path: str, snapshot: Snapshot) -> None:
+    strings = {}
+
+    def string(value):
+        if value is None:
+            return -1
+        return strings.setdefault(value, len(strings))
+
+    flags = {}
+    for guild_id in snapshot.non_leveling:
+        flags[guild_id] = flags.get(guild_id, 0) | NON_LEVELING
+    for guild_id in snapshot.welcoming:
+        flags[guild_id] = flags.get(guild_id, 0) | WELCOMING
+
+    body = bytearray()
+    body += COUNT.pack(len(flags))
+    for guild_id, flag in flags.items():
+        body += GUILD_FLAGS.pack(guild_id, flag)
+
+    body += COUNT.pack(len(snapshot.cooldowns))
+    for guild_id, user_id, command, expires in snapshot.cooldowns:
+        body += COOLDOWN.pack(guild_id or 0, user_id, string(command), expires)
+
+    body += COUNT.pack(len(snapshot.economy))
+    for guild_id, users in snapshot.economy.items():
+        body += GUILD.pack(guild_id, len(users))
+        for user_id, user in users.items():
+            body += USER.pack(user_id, user.cash, user.vault, user.xp, user.level, string(user.pet_name))
+
+    header = bytearray(MAGIC)
+    header += COUNT.pack(len(strings))
+    for value in strings:
+        encoded = value.encode('utf-8')
+        header += STRING.pack(len(encoded)) + encoded
+
+    temp = path + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(header)
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+    # the rename itself only survives a power cut once the directory is synced too, not possible on Windows
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def read_snapshot(path: str):
+    """Returns the :class:`Snapshot` at ``path``, or None if there isn't a usable one."""
+    try:
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None  # missing, or empty like after a crash before anything was written
+
+    with mm:
+        if mm[:len(MAGIC)] != MAGIC:
+            return None
+        view = memoryview(mm)
+        try:
+            offset = len(MAGIC)
+
+            def read(fmt: struct.Struct, count: int = 1):
+                nonlocal offset
+                end = offset + fmt.size * count
+                items = list(fmt.iter_unpack(view[offset:end]))
+                offset = end
+                return items
+
+            strings = []
+            for _ in range(read(COUNT)[0][0]):
+                length = read(STRING)[0][0]
+                strings.append(sys.intern(bytes(view[offset:offset + length]).decode('utf-8')))
+                offset += length
+
+            non_leveling, welcoming = set(), set()
+            for guild_id, flag in read(GUILD_FLAGS, read(COUNT)[0][0]):
+                if flag & NON_LEVELING:
+                    non_leveling.add(guild_id)
+                if flag & WELCOMING:
+                    welcoming.add(guild_id)
+
+            cooldowns = [
+                (guild_id or None, user_id, strings[command], expires)
+                for guild_id, user_id, command, expires in read(COOLDOWN, read(COUNT)[0][0])
+            ]
+
+            economy = {}
+            for _ in range(read(COUNT)[0][0]):
+                guild_id, count = read(GUILD)[0]
+                economy[guild_id] = {
+                    user_id: UserRecord(cash, vault, strings[pet] if pet >= 0 else None, xp, level)
+                    for user_id, cash, vault, xp, level, pet in read(USER, count)
+                }
+        except (struct.error, IndexError, UnicodeDecodeError):
+            return None  # cut short or corrupted
+        finally:
+            view.release()
+
+    return Snapshot(economy, cooldowns, non_leveling, welcoming)
@@ -0,0 +1,58 @@
+# hot-path statements, prepared once on every pool connection and run by name through Manager.run
+
+# every balance change is one guarded UPDATE returning what the cache should now hold, see EconomyNode._mutate,
+# xp isn't returned since the cached XP runs ahead of the table until the next flush
+RETURNING = "RETURNING cash, vault, pet_name, level, version"
+
+STATEMENTS = {
+    'add_cash': f"UPDATE users SET cash = cash + $1 WHERE guild_id = $2 AND user_id = $3 AND cash + $1 >= 0 {RETURNING}",
+    'add_vault': (
+        f"UPDATE users SET vault = vault + $1 WHERE guild_id = $2 AND user_id = $3 AND vault + $1 >= 0 {RETURNING}"
+    ),
+    'add_xp': f"UPDATE users SET xp = xp + $1 WHERE guild_id = $2 AND user_id = $3 {RETURNING}",
+    'add_level': (
+        f"UPDATE users SET level = level + $1 WHERE guild_id = $2 AND user_id = $3 AND level + $1 >= 1 {RETURNING}"
+    ),
+    'withdraw': (
+        f"UPDATE users SET cash = cash + $1, vault = vault - $1 WHERE guild_id = $2 AND user_id = $3 AND vault >= $1 "
+        f"{RETURNING}"
+    ),
+    'deposit': (
+        f"UPDATE users SET cash = cash - $1, vault = vault + $1 WHERE guild_id = $2 AND user_id = $3 AND cash >= $1 "
+        f"{RETURNING}"
+    ),
+    'level_up': (
+        f"UPDATE users SET level = level + 1, xp = xp - $1 WHERE guild_id = $2 AND user_id = $3 AND level = $4 "
+        f"{RETURNING}"
+    ),
+    'edit_pet': f"UPDATE users SET pet_name = $1 WHERE guild_id = $2 AND user_id = $3 {RETURNING}",
+    'register_user': (
+        """
+        WITH inserted AS (
+            INSERT INTO users VALUES ($1, $2) RETURNING *
+        ), counted AS (
+            UPDATE guilds SET user_count = user_count + 1 WHERE guild_id = $1
+        )
+        SELECT * FROM inserted
+        """
+    ),
+    'get_tag': (
+        """
+        SELECT
+            tags.name, tags.content
+        FROM
+            tag_search
+        INNER JOIN
+            tags ON
+                tags.tag_id = tag_search.tag_id
+        WHERE
+            tag_search.guild_id = $1 AND LOWER(tag_search.name) = $2
+        """
+    ),
+    'use_tag': "UPDATE tags SET uses = uses + 1 WHERE name = $2 AND guild_id = $1",
+}
+
+
+async def prepare_statements(conn) -> None:
+    """``init`` hook for the pool, so the first command on a fresh connection doesn't pay for the parse."""
+    await conn.prepare_statements()